@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+"""
+Storage benchmarks for task.py, run headless against temporary databases.
+
+    python bench.py ops [--tasks N] [--messages N] [--depth N] [--fanout N]
+                        [--output results.json] [--compare baseline.json]
+    python bench.py pragmas [--tasks N] [--messages N]
+    python bench.py startup [--runs N] [--tasks N]
+    python bench.py records [--tasks N] [--runs N]
+    python bench.py select [--tasks N] [--messages N]
+    python bench.py archive [--messages N]
+    python bench.py backup [--tasks N] [--messages N]
+    python bench.py stress [--processes 1,2,4,8] [--writes N]
+    python bench.py view [--tasks N] [--depth N] [--fanout N]
+
+Each scenario builds a synthetic book, times every operation and prints a
+table. --output saves the results as JSON and --compare prints the change
+against a previously saved run.
+"""
+
+import sys
+import os.path
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import datetime
+import platform
+import json
+import subprocess
+import threading
+
+import task
+
+#--------------------------------------------------------------------------
+def make_tree( tasks, depth, fanout ):
+    """Yield ( taskid, parent ) breadth first, as a forest of trees depth levels deep."""
+    taskid = 0
+    while True:
+        level = [ None ]
+        for d in xrange( depth ):
+            below = []
+            for parent in level:
+                for k in xrange( 1 if parent is None else fanout ):
+                    taskid += 1
+                    if taskid > tasks:
+                        return
+                    yield taskid, parent
+                    below.append( taskid )
+            level = below
+
+#--------------------------------------------------------------------------
+def fill_database( db, tasks, messages, depth, fanout ):
+    """Bulk load a synthetic book and message log."""
+    with db.transaction() as conn:
+        rows = []
+        for taskid, parent in make_tree( tasks, depth, fanout ):
+            rows.append( ( taskid, "task %u" % taskid, "details of task %u" % taskid, parent, random.randint(1,3) ) )
+            if len(rows) == 10000:
+                conn.executemany( "INSERT INTO Task ( taskid, name, details, parent, statusid ) VALUES (?,?,?,?,?)", rows )
+                rows = []
+        conn.executemany( "INSERT INTO Task ( taskid, name, details, parent, statusid ) VALUES (?,?,?,?,?)", rows )
+
+        start = datetime.datetime( 2010, 1, 1 )
+        rows = []
+        for msgid in xrange( 1, messages+1 ):
+            ts = start + datetime.timedelta( minutes=10*msgid )
+            rows.append( ( ts.date(), ts, "log message %u" % msgid ) )
+            if len(rows) == 10000:
+                conn.executemany( "INSERT INTO Message ( date, ts, text ) VALUES (?,?,?)", rows )
+                rows = []
+        conn.executemany( "INSERT INTO Message ( date, ts, text ) VALUES (?,?,?)", rows )
+
+#--------------------------------------------------------------------------
+def measure( func, count ):
+    """Run func count times, returning a dict of throughput and latency figures."""
+    latencies = []
+    clock = time.time
+    start = clock()
+    for i in xrange( count ):
+        before = clock()
+        func( i )
+        latencies.append( clock() - before )
+    return figures( latencies, clock() - start )
+
+def figures( latencies, elapsed ):
+    """Throughput and latency figures for a list of per operation times."""
+    count = len(latencies)
+    latencies = sorted( latencies )
+    def percentile( p ):
+        return latencies[ min( count-1, int( p * count ) ) ] * 1000.0
+    return {
+        'count'   : count,
+        'seconds' : elapsed,
+        'ops_sec' : count / elapsed if elapsed else float('inf'),
+        'p50_ms'  : percentile( 0.50 ),
+        'p95_ms'  : percentile( 0.95 ),
+        'max_ms'  : latencies[-1] * 1000.0
+    }
+
+def report( results ):
+    print "%-24s %8s %10s %12s %10s %10s %10s" % ( 'operation', 'count', 'seconds', 'ops/sec', 'p50 ms', 'p95 ms', 'max ms' )
+    for name in sorted( results ):
+        r = results[name]
+        print "%-24s %8u %10.3f %12.1f %10.3f %10.3f %10.3f" % (
+            name, r['count'], r['seconds'], r['ops_sec'], r['p50_ms'], r['p95_ms'], r['max_ms'] )
+
+def compare( results, baseline ):
+    print "%-24s %12s %12s %8s" % ( 'operation', 'base p50 ms', 'p50 ms', 'speedup' )
+    for name in sorted( results ):
+        if name in baseline:
+            old, new = baseline[name]['p50_ms'], results[name]['p50_ms']
+            print "%-24s %12.3f %12.3f %7.2fx" % ( name, old, new, old / new if new else float('inf') )
+
+#--------------------------------------------------------------------------
+def bench_ops( args, workdir ):
+    """Time the Taskbook, TaskTable, MessageTable and search hot paths on one synthetic book."""
+    db = task.Database( os.path.join( workdir, 'ops.db' ), hierarchy=not args.no_hierarchy )
+    start = time.time()
+    fill_database( db, args.tasks, args.messages, args.depth, args.fanout )
+    print "Built %u tasks and %u messages in %.1f s" % ( args.tasks, args.messages, time.time() - start )
+
+    book = task.Taskbook( db )
+    book.refresh()
+    ids = list( book._tasks )
+    lastmsg = db.cursor().execute( "SELECT MAX(msgid) FROM Message" ).fetchone()[0] or 1
+
+    def random_path( i ):
+        indices, task = [], book.item( () )
+        while task.kids and len(indices) < args.depth:
+            indices.append( random.randrange( len( task.kids ) ) )
+            task = book.item( indices )
+        return indices
+
+    paths = [ random_path( i ) for i in xrange( args.lookups ) ]
+    # delete from the second deepest level so each delete removes a small subtree
+    victims = [ id for id in ids if len( book.path( id ) or [] ) == max( 1, args.depth - 1 ) ][:args.writes]
+    # reorders within a parent: ( taskid, parent, sibling to go before )
+    reorders = []
+    for id in random.sample( ids, min( len(ids), args.writes ) ):
+        parent = book._tasks[id].parent
+        siblings = [ kid for kid in book._node( parent ).kids if kid != id ]
+        if siblings:
+            reorders.append( ( id, parent, random.choice( siblings ) ) )
+
+    operations = [
+        ( 'Taskbook.refresh',       lambda i: book.refresh(),                                   args.reloads ),
+        ( 'Taskbook.sync',          lambda i: book.sync(),                                      args.lookups ),
+        ( 'Taskbook.select',        lambda i: book.select( random.choice( ids ) ),              args.lookups ),
+        ( 'Taskbook.item',          lambda i: book.item( paths[i] ),                            args.lookups ),
+        ( 'Taskbook._kids',         lambda i: book._kids( random.choice( ids ) ),               args.lookups ),
+        ( 'Taskbook.children',      lambda i: book.children( random.choice( ids ) ),            args.lookups ),
+        ( 'Taskbook.search',        lambda i: book.search( '"message %u"' % random.randint( 1, lastmsg ), raw=True ), args.lookups ),
+        ( 'TaskTable.insert',       lambda i: db.tasks.insert( "bench %u" % i ),                args.writes ),
+        ( 'TaskTable.descendants',  lambda i: db.tasks.descendants( random.choice( ids ) ),     args.lookups ),
+        ( 'MessageTable.select',    lambda i: db.messages.select( limit=100, after_id=random.randint( 1, lastmsg ) ), args.lookups ),
+        ( 'MessageTable.select.all', lambda i: db.messages.select(),                            args.reloads ),
+        ( 'Taskbook.move.before',   lambda i: book.move( *reorders[i] ),                        len(reorders) ),
+        ( 'Taskbook.delete',        lambda i: book.delete( victims[i] ),                        len(victims) )
+    ]
+
+    results = {}
+    for name, func, count in operations:
+        if count:
+            results[ name ] = measure( func, count )
+    return results
+
+#--------------------------------------------------------------------------
+def bench_pragmas( args, workdir ):
+    """Compare the old connection setup (no PRAGMAs, no secondary indexes) with the tuned profile."""
+    results = {}
+    for profile in [ 'default', 'tuned' ]:
+        filename = os.path.join( workdir, "%s.db" % profile )
+        db = task.Database( filename, hierarchy=False, profile=profile )
+        fill_database( db, args.tasks, args.messages, args.depth, args.fanout )
+        if profile == 'default':
+            # reproduce the schema from before the indexes were added; dropped after
+            # the fill, which TaskPositionInsert would make quadratic without them
+            for index in [ 'TaskParentStatus', 'TaskParentPosition', 'TaskStatus', 'MessageDateTs' ]:
+                db.connection().execute( "DROP INDEX IF EXISTS %s" % index )
+
+        days = ( args.messages * 10 ) // ( 24 * 60 ) + 1
+        first = datetime.date( 2010, 1, 1 )
+        cursor = db.cursor()
+
+        def children( i ):
+            cursor.execute( "SELECT taskid, name FROM Task WHERE parent=?", ( random.randint( 1, args.tasks ), ) ).fetchall()
+
+        def messages( i ):
+            day = first + datetime.timedelta( days=random.randint( 0, days ) )
+            cursor.execute( "SELECT date, ts, text FROM Message WHERE date=?", ( day, ) ).fetchall()
+
+        def inserts( i ):
+            db.tasks.insert( "bench %u" % i )
+
+        for name, func, count in [ ( 'child lookup', children, args.lookups ),
+                                   ( 'messages by date', messages, args.lookups ),
+                                   ( 'insert + commit', inserts, args.writes ) ]:
+            results[ "%s: %s" % ( profile, name ) ] = measure( func, count )
+
+        db.connection().close()
+    return results
+
+#--------------------------------------------------------------------------
+def bench_startup( args, workdir ):
+    """
+    Time fresh CLI processes, the cost every 'task add' pays without the daemon,
+    on a nearly empty book and then on one of --tasks tasks.
+    """
+    env = dict( os.environ )
+    env.pop( 'LOCALAPPDATA', None )
+    env[ 'XDG_DATA_HOME' ] = workdir
+    env[ 'TASK_NO_DAEMON' ] = '1'
+    env.pop( 'PYTHONDONTWRITEBYTECODE', None ) # measure with task.pyc cached, as installed
+    script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'task.py' )
+    devnull = open( os.devnull, 'w' )
+
+    def run( command, env=env ):
+        return lambda i: subprocess.check_call( [ sys.executable ] + command, env=env, stdout=devnull,
+                                                cwd=os.path.dirname( script ) )
+
+    # first run creates the database so later runs see an existing schema
+    run( [ script, 'list' ] )( 0 )
+    results = {}
+    for name, command in [ ( 'python (floor)', [ '-c', 'pass' ] ),
+                           ( 'import task',    [ '-c', 'import task' ] ),
+                           ( 'task add',       [ script, 'add', 'bench' ] ),
+                           ( 'task list',      [ script, 'list' ] ) ]:
+        results[ name ] = measure( run( command ), args.runs )
+
+    # the same writes against a big book, which they should not have to load
+    large = dict( env, XDG_DATA_HOME=os.path.join( workdir, 'large' ) )
+    os.makedirs( os.path.join( large['XDG_DATA_HOME'], 'jfs-tasks' ) )
+    db = task.Database( os.path.join( large['XDG_DATA_HOME'], 'jfs-tasks', 'tasks.db' ) )
+    fill_database( db, args.tasks, 0, args.depth, args.fanout )
+    db.connection().close()
+    print "Big book of %u tasks" % args.tasks
+    for name, command in [ ( 'task add',          [ script, 'add', 'bench' ] ),
+                           ( 'task edit',         [ script, 'edit', '1', 'bench' ] ),
+                           ( 'task move',         [ script, 'move', str( args.tasks ), '1' ] ),
+                           ( 'task status',       [ script, 'status', '1', 'C' ] ),
+                           ( 'task list --limit', [ script, 'list', '--limit', '20' ] ) ]:
+        results[ "%s (big)" % name ] = measure( run( command, large ), args.runs )
+    devnull.close()
+    return results
+
+#--------------------------------------------------------------------------
+def load_dicts( db ):
+    """The per-row dict cache Taskbook.refresh built before TaskRecord, for comparison."""
+    tasks = dict()
+    raw = db.tasks.select()
+    for row in raw:
+        row['kids'] = []
+        tasks[ row['taskid'] ] = row
+    for row in raw:
+        if row['parent'] in tasks:
+            tasks[ row['parent'] ]['kids'].append( row['taskid'] )
+    return tasks
+
+def load_records( db ):
+    book = task.Taskbook( db )
+    book.refresh()
+    return book
+
+def probe( kind, filename ):
+    """Load one cache representation in this process, printing time and peak RSS growth as JSON."""
+    import resource
+    db = task.Database( filename )
+    before = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    start = time.time()
+    cache = { 'dicts': load_dicts, 'records': load_records }[ kind ]( db )
+    elapsed = time.time() - start
+    after = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    print json.dumps( { 'seconds': elapsed, 'rss_kib': after - before } )
+
+def bench_records( args, workdir ):
+    """Compare load time and memory of per-row dicts against slotted TaskRecords."""
+    filename = os.path.join( workdir, 'records.db' )
+    db = task.Database( filename, hierarchy=False )
+    fill_database( db, args.tasks, 0, args.depth, args.fanout )
+    db.connection().close()
+
+    results = {}
+    for kind in [ 'dicts', 'records' ]:
+        runs = []
+        def run( i ):
+            output = subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ), '--probe', kind, filename ] )
+            runs.append( json.loads( output ) )
+        results[ kind ] = measure( run, args.runs )
+        results[ kind ][ 'load_p50_ms' ] = sorted( r['seconds'] for r in runs )[ len(runs) // 2 ] * 1000.0
+        results[ kind ][ 'rss_mib' ] = max( r['rss_kib'] for r in runs ) / 1024.0
+
+    print "%-10s %12s %12s" % ( 'cache', 'load p50 ms', 'peak MiB' )
+    for kind in [ 'dicts', 'records' ]:
+        print "%-10s %12.1f %12.1f" % ( kind, results[kind]['load_p50_ms'], results[kind]['rss_mib'] )
+    print
+    return results
+
+#--------------------------------------------------------------------------
+def bench_select( args, workdir ):
+    """Time whole-table and paged selects as dicts, sqlite3.Row and plain tuples."""
+    db = task.Database( os.path.join( workdir, 'select.db' ), hierarchy=False )
+    fill_database( db, args.tasks, args.messages, args.depth, args.fanout )
+    lastmsg = max( 1, args.messages )
+    # paging callers ask for a handful of different projections
+    projections = [ task.MESSAGE_COLUMNS, task.MESSAGE_COLUMNS[1:], ( 'msgid', 'text' ) ]
+
+    def tuples( sql ):
+        return lambda i: db.cursor().execute( sql ).fetchall()
+
+    operations = [
+        ( 'TaskTable.select.dicts',    lambda i: db.tasks.select(),                                  args.reloads ),
+        ( 'TaskTable.select.rows',     lambda i: db.tasks.select( row_factory=task.sqlite3.Row ),    args.reloads ),
+        ( 'TaskTable.select.tuples',   tuples( "SELECT taskid,name,details,parent,statusid FROM Task ORDER BY taskid" ), args.reloads ),
+        ( 'MessageTable.select.dicts', lambda i: db.messages.select(),                               args.reloads ),
+        ( 'MessageTable.select.rows',  lambda i: db.messages.select( row_factory=task.sqlite3.Row ), args.reloads ),
+        ( 'MessageTable.select.page',  lambda i: db.messages.select( projections[ i % 3 ], limit=20,
+                                                                     after_id=random.randint( 1, lastmsg ) ), args.lookups )
+    ]
+    results = {}
+    for name, func, count in operations:
+        results[ name ] = measure( func, count )
+    return results
+
+#--------------------------------------------------------------------------
+def bench_archive( args, workdir ):
+    """Time recent and historic message queries and the live file size before and after archiving."""
+    filename = os.path.join( workdir, 'archive.db' )
+    db = task.Database( filename, hierarchy=False )
+    fill_database( db, 0, args.messages, args.depth, args.fanout )
+    dates = [ row[0] for row in db.messages.daily() ]
+    keep = dates[ max( 0, len(dates) - 365 ) ] # the last year of logging stays live
+
+    def size():
+        return sum( os.path.getsize( filename + suffix ) for suffix in ( '', '-wal' ) if os.path.exists( filename + suffix ) ) / 1048576.0
+
+    def pages( since ):
+        return lambda i: db.messages.select( since=since, limit=100 )
+
+    operations = [
+        ( 'recent.page',   pages( keep ),                                                   args.lookups ),
+        ( 'historic.page', lambda i: pages( random.choice( dates[:len(dates)//2] ) )( i ),  args.lookups ),
+        ( 'daily.all',     lambda i: db.messages.daily(),                                   args.reloads ),
+        ( 'iterate.all',   lambda i: sum( 1 for row in db.messages.iterate() ),             args.reloads )
+    ]
+    results = {}
+    for name, func, count in operations:
+        results[ 'live.' + name ] = measure( func, count )
+    live = size()
+
+    start = time.time()
+    days, moved = db.messages.archive( keep )
+    seconds = time.time() - start
+    rows = db.connection().execute( "SELECT ( SELECT COUNT(*) FROM Change ), ( SELECT COUNT(*) FROM Message )" ).fetchone()
+    db.connection().execute( "VACUUM" )
+    db.connection().execute( "PRAGMA wal_checkpoint(TRUNCATE)" ).fetchall()
+    for name, func, count in operations:
+        results[ 'archived.' + name ] = measure( func, count )
+    folder = os.path.join( workdir, 'archive' ) # missing when no day was old enough to archive
+    archives = sum( os.path.getsize( os.path.join( folder, name ) ) for name in ( os.listdir( folder ) if os.path.isdir( folder ) else [] ) )
+
+    print "Archived %u messages from %u days in %.1f s" % ( moved, days, seconds )
+    print "Live database %.1f MiB -> %.1f MiB, archives %.1f MiB" % ( live, size(), archives / 1048576.0 )
+    print "Left live: %u Change rows, %u Message rows" % rows
+    print
+    return results
+
+#--------------------------------------------------------------------------
+def bench_backup( args, workdir ):
+    """Time Database.snapshot both ways, and the inserts another connection makes meanwhile."""
+    filename = os.path.join( workdir, 'backup.db' )
+    db = task.Database( filename, hierarchy=not args.no_hierarchy )
+    fill_database( db, args.tasks, args.messages, args.depth, args.fanout )
+    print "Live database %.1f MiB" % ( os.path.getsize( filename ) / 1048576.0 )
+
+    def write_while( func ):
+        # a second connection, on a thread of its own, inserting tasks for as long as func runs
+        latencies, done = [], threading.Event()
+        start = time.time()
+        def loop():
+            writer = task.Database( filename, hierarchy=not args.no_hierarchy )
+            while not done.is_set():
+                before = time.time()
+                writer.tasks.insert( "written during backup" )
+                latencies.append( time.time() - before )
+            writer.connection().close()
+        thread = threading.Thread( target=loop )
+        thread.start()
+        try:
+            result = func()
+        finally:
+            done.set()
+            thread.join()
+        return result, figures( latencies, time.time() - start )
+
+    results = {}
+    _, results[ 'insert (idle)' ] = write_while( lambda: time.sleep( 1.0 ) )
+    methods = [ ( 'vacuum', True ) ]
+    if hasattr( db.connection(), 'backup' ):
+        methods.insert( 0, ( 'backup', False ) )
+    for name, vacuum in methods:
+        copy = os.path.join( workdir, 'copy-%s.db' % name )
+        snapshot, results[ 'insert during %s' % name ] = write_while(
+            lambda: db.snapshot( copy, vacuum=vacuum ) )
+        results[ 'snapshot %s' % name ] = figures( [ snapshot['seconds'] ], snapshot['seconds'] )
+        print "%s: %.1f MiB in %.1f s, integrity %s" % ( name, snapshot['bytes'] / 1048576.0, snapshot['seconds'], snapshot['integrity'] )
+    print
+    return results
+
+#--------------------------------------------------------------------------
+# Connection profiles the stress scenario compares; 'nowait' leaves all the
+# waiting to Database.transaction's retries.
+STRESS_PROFILES = {
+    'tuned'   : task.PROFILES['tuned'],
+    'default' : task.PROFILES['default'],
+    'nowait'  : [ ( 'busy_timeout', 0 ) ] + task.PROFILES['tuned'][1:]
+}
+
+def hammer( filename, profile, index, count ):
+    """Child process of the stress scenario: add, move and delete count times, printing a JSON tally."""
+    db = task.Database( filename, profile=STRESS_PROFILES[ profile ] )
+    book = task.Taskbook( db )
+    root = book.add( "stress %s" % index )
+    alive, deleted, failed, latencies = [], [], 0 if root else 1, []
+    for i in xrange( count ):
+        before = time.time()
+        if i % 4 == 3 and alive:
+            taskid = alive.pop( random.randrange( len(alive) ) )
+            ok = book.delete( taskid ) is not None
+            deleted.append( taskid )
+        elif i % 4 == 2 and alive and root:
+            ok = book.move( random.choice( alive ), root )
+        else:
+            taskid = book.add( "stress %s-%u" % ( index, i ) )
+            ok = bool( taskid )
+            if ok:
+                alive.append( taskid )
+        latencies.append( time.time() - before )
+        failed += not ok
+    print json.dumps( { 'alive': alive, 'deleted': deleted, 'failed': failed, 'latencies': latencies,
+                        'contention': db.contention() } )
+
+def bench_stress( args, workdir ):
+    """Run processes adding, moving and deleting at once; count failed and lost writes and lock waits."""
+    script = os.path.abspath( __file__ )
+    results = {}
+    for profile in sorted( STRESS_PROFILES ):
+        for processes in [ int( n ) for n in args.processes.split( ',' ) ]:
+            filename = os.path.join( workdir, 'stress-%s-%u.db' % ( profile, processes ) )
+            task.Database( filename, profile=STRESS_PROFILES[ profile ] ).connection().close() # schema in place before the race
+            start = time.time()
+            children = [ subprocess.Popen( [ sys.executable, script, '--hammer', filename, profile, str(n), str( args.writes ) ],
+                                           stdout=subprocess.PIPE ) for n in xrange( processes ) ]
+            tallies = [ json.loads( child.communicate()[0] ) for child in children ]
+            elapsed = time.time() - start
+
+            db = task.Database( filename )
+            present = set( row[0] for row in db.cursor().execute( "SELECT taskid FROM Task" ) )
+            lost = sum( len( set( tally['alive'] ) - present ) + len( set( tally['deleted'] ) & present ) for tally in tallies )
+            db.connection().close()
+            contention = dict( ( name, sum( tally['contention'][name] for tally in tallies ) ) for name in task.CONTENTION_COUNTERS )
+            contention['max_wait'] = max( tally['contention']['max_wait'] for tally in tallies )
+
+            name = "%s x%u" % ( profile, processes )
+            results[ name ] = figures( [ latency for tally in tallies for latency in tally['latencies'] ], elapsed )
+            results[ name ].update( failed=sum( tally['failed'] for tally in tallies ), lost=lost, contention=contention )
+            print "%-12s %8.1f ops/sec  %u failed  %u lost  %u of %u contended  %u retries  longest wait %.3f s" % (
+                name, results[name]['ops_sec'], results[name]['failed'], lost, contention['contended'],
+                contention['transactions'], contention['retries'], contention['max_wait'] )
+    print
+    return results
+
+#--------------------------------------------------------------------------
+def bench_view( args, workdir ):
+    """Save and restore a GUI view, against the str()/eval() of index tuples it replaced."""
+    db = task.Database( os.path.join( workdir, 'view.db' ), hierarchy=False )
+    fill_database( db, args.tasks, 0, args.depth, args.fanout )
+    book = task.Taskbook( db )
+    book.refresh()
+
+    # every task with kids expanded down to the level above the leaves
+    expanded, indices = [], []
+    stack = [ ( book.item( () ), () ) ]
+    while stack:
+        node, index = stack.pop()
+        for n, kid in enumerate( node.kids ):
+            child = book._tasks[ kid ]
+            if child.kids and len( index ) < args.depth - 2:
+                expanded.append( kid )
+                indices.append( index + ( n, ) )
+                stack.append( ( child, index + ( n, ) ) )
+    screen = [ [ kid.parent, kid.taskid, kid.name, kid.statusid, kid.count, None ]
+               for kid in db.tasks.children( None )[:100] ]
+    state = { 'expanded': sorted( expanded ), 'screen': screen }
+    text = str( indices )
+
+    results = {
+        'ViewState save'  : measure( lambda i: db.save_view_state( 'bench', state ), args.reloads ),
+        'ViewState load'  : measure( lambda i: db.view_state( 'bench' ), args.reloads ),
+        'str() of tuples' : measure( lambda i: str( indices ), args.reloads ),
+        'eval() of tuples': measure( lambda i: eval( text ), args.reloads )
+    }
+    blob = db.connection().execute( "SELECT length(data) FROM ViewState WHERE name='bench'" ).fetchone()[0]
+    print "%u expanded tasks: ViewState %.1f KiB, str() of index tuples %.1f KiB" % ( len( expanded ), blob / 1024.0, len( text ) / 1024.0 )
+    print
+    return results
+
+#--------------------------------------------------------------------------
+SCENARIOS = {
+    'archive' : bench_archive,
+    'backup'  : bench_backup,
+    'ops'     : bench_ops,
+    'pragmas' : bench_pragmas,
+    'records' : bench_records,
+    'select'  : bench_select,
+    'startup' : bench_startup,
+    'stress'  : bench_stress,
+    'view'    : bench_view
+}
+
+#--------------------------------------------------------------------------
+def main( argv ):
+    parser = argparse.ArgumentParser( description="task.py storage benchmarks" )
+    parser.add_argument( 'scenario', nargs='?', default='ops', choices=sorted( SCENARIOS ) )
+    parser.add_argument( '--tasks', type=int, default=1000000 )
+    parser.add_argument( '--messages', type=int, default=1000000 )
+    parser.add_argument( '--depth', type=int, default=7, help="levels per synthetic tree" )
+    parser.add_argument( '--fanout', type=int, default=10, help="kids per task" )
+    parser.add_argument( '--lookups', type=int, default=200, help="repetitions of cheap operations" )
+    parser.add_argument( '--writes', type=int, default=500, help="repetitions of write operations" )
+    parser.add_argument( '--reloads', type=int, default=3, help="repetitions of full table operations" )
+    parser.add_argument( '--runs', type=int, default=20, help="processes started by the startup scenario" )
+    parser.add_argument( '--processes', default='1,2,4,8', help="writer counts of the stress scenario" )
+    parser.add_argument( '--no-hierarchy', action='store_true', help="build the book without the path index" )
+    parser.add_argument( '--seed', type=int, default=1 )
+    parser.add_argument( '--output', help="write results to this JSON file" )
+    parser.add_argument( '--compare', help="compare against a JSON file from an earlier --output" )
+    parser.add_argument( '--probe', nargs=2, metavar=( 'KIND', 'FILE' ), help=argparse.SUPPRESS )
+    parser.add_argument( '--hammer', nargs=4, metavar=( 'FILE', 'PROFILE', 'INDEX', 'COUNT' ), help=argparse.SUPPRESS )
+    if '--probe' in argv:
+        # child process of the records scenario
+        kind, filename = argv[ argv.index( '--probe' ) + 1: ][:2]
+        probe( kind, filename )
+        return 0
+    if '--hammer' in argv:
+        # child process of the stress scenario
+        filename, profile, index, count = argv[ argv.index( '--hammer' ) + 1: ][:4]
+        hammer( filename, profile, index, int( count ) )
+        return 0
+    args = parser.parse_args( argv )
+
+    random.seed( args.seed )
+    workdir = tempfile.mkdtemp( prefix='task-bench-' )
+    try:
+        results = SCENARIOS[ args.scenario ]( args, workdir )
+    finally:
+        shutil.rmtree( workdir )
+
+    report( results )
+    if args.compare:
+        with open( args.compare ) as f:
+            baseline = json.load( f )
+        print
+        compare( results, baseline['results'] )
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            json.dump( {
+                'scenario' : args.scenario,
+                'options'  : vars( args ),
+                'python'   : platform.python_version(),
+                'sqlite'   : task.sqlite3.sqlite_version,
+                'platform' : platform.platform(),
+                'time'     : datetime.datetime.now().isoformat(),
+                'results'  : results
+            }, f, indent=2, sort_keys=True )
+    return 0
+
+#--------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit( main( sys.argv[1:] ) )
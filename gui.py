@@ -4,54 +4,401 @@
 import task
 import wx
 import os
+import logging
+import threading
+import Queue
 
 try:
     import treemixin
 except ImportError:
     from wx.lib.mixins import treemixin
 
+#--------------------------------------------------------------
+# Rows of the tree saved with the view, painted on the next launch before any
+# branch has loaded; comfortably more than a window shows.
+SCREEN_ROWS = 100
+
+#--------------------------------------------------------------
+# Task changes a Sync fetches at most; further behind, it refetches every
+# loaded branch instead of reading the whole backlog of the change feed.
+SYNC_CHANGES = 1000
+
+#--------------------------------------------------------------
+class TaskWorker(threading.Thread):
+    """
+    Runs the GUI's database work on one thread with its own connection, in the
+    order it was submitted, and hands each result back to the UI thread through
+    wx.CallAfter. A job that raises reports None. Writes queued back to back
+    share one transaction, so they wait for the write lock once between them.
+    """
+    def __init__(self, filename=None):
+        threading.Thread.__init__( self, name="TaskWorker" )
+        self.daemon = True
+        self._filename = filename
+        self._jobs = Queue.Queue()
+
+    def run(self):
+        # sqlite3 connections belong to the thread that opened them
+        taskbook = task.Taskbook( task.Database( self._filename ) )
+        ahead = [] # job taken off the queue while gathering writes
+        while True:
+            job = ahead.pop() if ahead else self._jobs.get()
+            if job is None:
+                break
+            jobs = [ job ]
+            while job[2]:
+                try:
+                    job = self._jobs.get_nowait()
+                except Queue.Empty:
+                    break
+                if job is None or not job[2]:
+                    ahead.append( job )
+                    break
+                jobs.append( job )
+            for callback, result in self._Run( taskbook, jobs ):
+                if callback:
+                    wx.CallAfter( callback, result )
+
+    def _Run(self, taskbook, jobs):
+        # [ ( callback, result ) ] for jobs, several writes in one batch
+        if len( jobs ) > 1:
+            try:
+                with taskbook.batch():
+                    return [ ( callback, func( taskbook ) ) for func, callback, write in jobs ]
+            except Exception:
+                logging.warning( "Grouped writes rolled back, running them one by one" )
+        results = []
+        for func, callback, write in jobs:
+            try:
+                result = func( taskbook )
+            except Exception:
+                logging.exception( "Background task failed" )
+                result = None
+            results.append( ( callback, result ) )
+        return results
+
+    def Submit(self, func, callback=None, write=False):
+        """
+        Run func( taskbook ) on the worker, then callback( result ) on the UI
+        thread. Writes are grouped with the writes queued next to them.
+        """
+        self._jobs.put( ( func, callback, write ) )
+
+    def Stop(self):
+        # finishes the writes already queued
+        self._jobs.put( None )
+        self.join()
+
+#--------------------------------------------------------------
+def _LoadBranch(taskbook, parentid):
+    # runs on the worker: parentid's kids plus the badge counts of those with kids
+    kids = taskbook.children( parentid ) or []
+    counts = dict( ( kid.taskid, taskbook.counts( kid.taskid ) or {} ) for kid in kids if kid.count )
+    return kids, counts
+
+def _LoadBranches(taskbook, parentids):
+    # runs on the worker: _LoadBranch for each of parentids, in one job
+    return [ _LoadBranch( taskbook, parentid ) for parentid in parentids ]
+
+def _Changes(taskbook, seq):
+    # runs on the worker: ( data_version, Task changes since seq or None, newest seq ).
+    # None when more than SYNC_CHANGES arrived, refetching the loaded branches is
+    # cheaper then. The newest seq is read first so no change can fall between.
+    newest = taskbook.last_change()
+    changes = taskbook.changes_since( seq, limit=SYNC_CHANGES + 1, tablename='Task' ) if seq is not None else None
+    if changes is not None and len( changes ) > SYNC_CHANGES:
+        changes = None
+    return taskbook.data_version(), changes, newest
+
 #--------------------------------------------------------------
 class TaskModel(object):
-    def __init__(self, taskbook):
-        self._taskbook = taskbook
+    """
+    Answers the tree from the branches loaded so far; the UI thread never touches
+    the database. Missing or stale branches are fetched by the TaskWorker, and the
+    tree is refreshed once they arrive, stale ones being shown until then. Every
+    cached task carries its own child count, so collapsed nodes never load their
+    kids. Edits change the loaded branches straight away and are put back if the
+    write fails.
+
+    With a view name the model starts from the first screen and expanded tasks
+    SaveView stored, shown as stale until every expanded branch has reloaded.
+    """
+    def __init__(self, worker, changed, view=None):
+        self._worker = worker
+        self._changed = changed # called on the UI thread when the tree should refresh
+        self._kids = {}         # { parentid: [ task, ... ] } for loaded branches
+        self._parents = {}      # { taskid: parentid } for every loaded task
+        self._counts = {}       # { taskid: { short status: count } } badges of loaded tasks with kids
+        self._stale = set()     # loaded branches that need fetching again
+        self._loading = set()   # branches requested from the worker
+        self._version = None
+        self._seq = None        # change feed position of the loaded branches
+        self._syncing = False
+        self._writes = 0        # writes submitted, a branch loaded before the last one is stale
+        self._newid = 0         # placeholder ids, below zero, for tasks not added yet
+        self._root = task.TaskRecord( None, 'Hidden root', '', None, None )
+        self._pending = task.TaskRecord( None, '...', '', None, None ) # rows of branches still loading
+        self._view = view
+        self._expanded = None   # taskids expanded when the view was saved, until taken
+        if view:
+            # queued first, so the saved screen arrives before any branch
+            self._worker.Submit( lambda taskbook: taskbook.view_state( view ), self._Restored )
+        self._worker.Submit( lambda taskbook: _Changes( taskbook, None ), self._Synced )
+
+    def _Children(self, parentid):
+        kids = self._kids.get( parentid )
+        if ( kids is None or parentid in self._stale ) and parentid not in self._loading:
+            self._loading.add( parentid )
+            self._stale.discard( parentid )
+            writes = self._writes
+            self._worker.Submit( lambda taskbook: _LoadBranch( taskbook, parentid ),
+                                 lambda result: self._Loaded( parentid, writes, result ) )
+        return kids or []
+
+    def _Restored(self, state):
+        if not state:
+            return
+        seeded = set()
+        for parentid, taskid, name, statusid, count, counts in state['screen']:
+            if parentid in self._kids and parentid not in seeded:
+                continue # loaded already, newer than the saved screen
+            seeded.add( parentid )
+            self._kids.setdefault( parentid, [] ).append( task.TaskRecord( taskid, name, '', parentid, statusid, count ) )
+            self._parents[ taskid ] = parentid
+            if counts:
+                self._counts[ taskid ] = counts
+        self._stale.update( seeded )
+        self._expanded = set( state['expanded'] )
+        # reload everything the restored tree shows as one job
+        parentids = [ None ] + [ taskid for taskid in state['expanded'] if taskid not in self._loading ]
+        self._loading.update( parentids )
+        self._stale.difference_update( parentids )
+        writes = self._writes
+        self._worker.Submit( lambda taskbook: _LoadBranches( taskbook, parentids ),
+                             lambda results: self._LoadedAll( parentids, writes, results ) )
+        self._changed()
+
+    def _LoadedAll(self, parentids, writes, results):
+        if results is None:
+            self._loading.difference_update( parentids )
+            self._stale.update( parentid for parentid in parentids if parentid in self._kids )
+            return
+        for parentid, result in zip( parentids, results ):
+            self._Loaded( parentid, writes, result, refresh=False )
+        self._changed()
+
+    def TakeExpanded(self):
+        """The restored view's expanded taskids, once."""
+        expanded, self._expanded = self._expanded, None
+        return expanded
+
+    def SaveView(self, expanded):
+        """Store expanded, a set of taskids, with the first SCREEN_ROWS rows they open."""
+        if not self._view:
+            return
+        screen = []
+        stack = [ iter( self._kids.get( None, [] ) ) ]
+        while stack and len( screen ) < SCREEN_ROWS:
+            kid = next( stack[-1], None )
+            if kid is None:
+                stack.pop()
+            elif kid.taskid is not None and kid.taskid > 0:
+                screen.append( [ kid.parent, kid.taskid, kid.name, kid.statusid, kid.count, self._counts.get( kid.taskid ) ] )
+                if kid.taskid in expanded and kid.taskid in self._kids:
+                    stack.append( iter( self._kids[ kid.taskid ] ) )
+        state = { 'expanded': sorted( taskid for taskid in expanded if taskid is not None and taskid > 0 ), 'screen': screen }
+        view = self._view
+        self._worker.Submit( lambda taskbook: taskbook.save_view_state( view, state ), write=True )
+
+    def _Loaded(self, parentid, writes, result, refresh=True):
+        self._loading.discard( parentid )
+        if result is None:
+            return
+        kids, counts = result
+        if writes != self._writes and parentid in self._kids:
+            # read before a write the tree already shows, keep that and fetch again
+            self._stale.add( parentid )
+            self._changed()
+            return
+        if parentid in self._stale:
+            # invalidated while loading, fetch once more
+            self._Children( parentid )
+        self._kids[ parentid ] = kids
+        self._counts.update( counts )
+        for kid in kids:
+            self._parents[ kid.taskid ] = parentid
+        if refresh:
+            self._changed()
+
+    def _Invalidate(self, parentid):
+        # parentid's kids, plus every branch above that shows a badge counting them
+        self._stale.add( parentid )
+        while parentid is not None:
+            parentid = self._parents.get( parentid )
+            self._stale.add( parentid )
+
+    def _Find(self, taskid):
+        for kid in self._kids.get( self._parents.get( taskid ), [] ):
+            if kid.taskid == taskid:
+                return kid
+        return None
+
+    def _Write(self, write, undo):
+        # run write on the worker, the tree already shows its outcome; undo if it fails
+        def done( ok ):
+            if not ok:
+                undo()
+                wx.Bell()
+            self.Sync()
+        self._writes += 1
+        self._worker.Submit( write, done, write=True )
+        self._changed()
+
+    def Sync(self):
+        """Ask the worker what other writers changed, including our own writes."""
+        if not self._syncing:
+            self._syncing = True
+            seq = self._seq
+            self._worker.Submit( lambda taskbook: _Changes( taskbook, seq ), self._Synced )
+
+    def _Synced(self, result):
+        self._syncing = False
+        if result is None:
+            return
+        version, changes, seq = result
+        if self._version is not None and changes is None:
+            # too far behind the change feed, refetch everything loaded
+            self._stale.update( self._kids )
+        for change in changes or []:
+            if change['tablename'] == 'Task':
+                self._stale.add( change['id'] )
+                self._Invalidate( change['parent'] )
+                if change['op'] == 'move':
+                    self._Invalidate( change['oldparent'] )
+        self._version, self._seq = version, seq
+        self._stale &= set( self._kids )
+        if self._stale:
+            self._changed()
+
+    def IsLoading(self):
+        return bool( self._loading )
 
     def GetItem(self, indices):
-        tasks = self._taskbook.select()
-        task = { 'name': 'Hidden root', 'kids': tasks, 'taskid': 0, 'parent': None }
+        task = self._root
         for i in indices:
-            task = tasks[i]
-            tasks =self._taskbook.select( parentid=task['taskid'] )
+            kids = self._Children( task.taskid )
+            if i >= len( kids ):
+                return self._pending
+            task = kids[i]
         return task
 
     def GetText(self, indices):
-        return self.GetItem( indices )['name']
+        task = self.GetItem( indices )
+        if not task.count:
+            return task.name
+        # open / total badge for tasks with kids
+        counts = self._counts.get( task.taskid ) or {}
+        return "%s  [%u/%u]" % ( task.name, counts.get( 'O', 0 ), sum( counts.itervalues() ) )
 
     def GetChildrenCount(self, indices):
-        return len( self.GetItem( indices )['kids'] )
+        if not indices:
+            return len( self._Children( None ) )
+        task = self.GetItem( indices )
+        if task is not self._pending and task.taskid in self._kids:
+            return len( self._kids[ task.taskid ] )
+        return task.count
 
     def GetItemId(self, indices):
         task = self.GetItem( indices )
-        return task['taskid']
-
-    def Move(self, source, dest):
-        self._taskbook.move( source, dest )
+        return task.taskid
+
+    def GetParentId(self, taskid):
+        return self._parents.get( taskid )
+
+    def Add(self, text):
+        self._newid -= 1
+        record = task.TaskRecord( self._newid, text, '', None, None )
+        kids = self._kids.setdefault( None, [] )
+        kids.append( record )
+        def undo():
+            if record in kids:
+                kids.remove( record )
+        # the next Sync reloads the top level, replacing the placeholder by the real task
+        self._Write( lambda taskbook: taskbook.add( text ), undo )
+
+    def Move(self, source, dest, before=None):
+        """Move source below dest (None for top level), ahead of the sibling before or last."""
+        record = self._Find( source )
+        if record is None or source == dest or source == before or source < 0 \
+           or ( dest is not None and dest < 0 ) or ( before is not None and before < 0 ):
+            return
+        oldParent = record.parent
+        oldKids, newKids = self._kids.get( oldParent ), self._kids.get( dest )
+        saved = list( oldKids or [] ), list( newKids or [] )
+        if oldKids is not None:
+            oldKids.remove( record )
+        if newKids is not None:
+            index = len( newKids )
+            for n, kid in enumerate( newKids ):
+                if kid.taskid == before:
+                    index = n
+            newKids.insert( index, record )
+        for taskid, step in ( ( oldParent, -1 ), ( dest, 1 ) ):
+            parent = self._Find( taskid )
+            if parent:
+                parent.count += step
+        record.parent = dest
+        self._parents[ source ] = dest
+        def undo():
+            if oldKids is not None:
+                oldKids[:] = saved[0]
+            if newKids is not None:
+                newKids[:] = saved[1]
+            for taskid, step in ( ( oldParent, 1 ), ( dest, -1 ) ):
+                parent = self._Find( taskid )
+                if parent:
+                    parent.count += step
+            record.parent = oldParent
+            self._parents[ source ] = oldParent
+        self._Write( lambda taskbook: taskbook.move( source, dest, before ), undo )
 
     def Edit(self, indices, text):
-        taskid = self.GetItemId( indices )
-        self._taskbook.update( taskid, text )
+        record = self.GetItem( indices )
+        if record.taskid is None or record.taskid < 0:
+            return
+        oldName = record.name
+        record.name = text
+        def undo():
+            record.name = oldName
+        self._Write( lambda taskbook: taskbook.update( record.taskid, text ), undo )
 
     def Delete(self, indices):
-        taskid = self.GetItemId( indices )
-        self._taskbook.delete( taskid )
+        record = self.GetItem( indices )
+        if record.taskid is None or record.taskid < 0:
+            return
+        kids = self._kids.get( record.parent, [] )
+        position = kids.index( record ) if record in kids else None
+        if position is not None:
+            del kids[ position ]
+        parent = self._Find( record.parent )
+        if parent:
+            parent.count -= 1
+        def undo():
+            if position is not None:
+                kids.insert( position, record )
+            if parent:
+                parent.count += 1
+        self._Write( lambda taskbook: taskbook.delete( record.taskid ), undo )
 
 #--------------------------------------------------------------
 class TaskTree(treemixin.VirtualTree, treemixin.DragAndDrop,
             treemixin.ExpansionState, wx.TreeCtrl):
 
     def __init__( self, *args, **kwargs ):
-        self.taskbook = kwargs.pop("taskbook")
+        self.worker = kwargs.pop("worker")
         super(TaskTree, self).__init__( *args, **kwargs )
-        self.model = TaskModel( self.taskbook )
+        self.model = TaskModel( self.worker, self.OnModelChanged, view='tasks' )
+        self.expansionState = None # taskids, restored as the branches they open arrive
         self.RefreshItems()
         self.CreateImageList()
 
@@ -61,6 +408,7 @@ class TaskTree(treemixin.VirtualTree, treemixin.DragAndDrop,
         self.MenuDeleteId = wx.NewId()
         self.Bind( wx.EVT_MENU, self.OnMenuDelete, id=self.MenuDeleteId )
 
+        self.Bind( wx.EVT_TREE_BEGIN_LABEL_EDIT, self.OnBeginEdit, self )
         self.Bind( wx.EVT_TREE_END_LABEL_EDIT, self.OnEndEdit, self )
         self.Bind( wx.EVT_TREE_ITEM_MENU, self.OnContextMenu )
 
@@ -80,6 +428,25 @@ class TaskTree(treemixin.VirtualTree, treemixin.DragAndDrop,
         else:
             return 1
 
+    def OnModelChanged(self):
+        if not self:
+            return # the window went while the worker was busy
+        self.RefreshItems()
+        if self.expansionState is None:
+            self.expansionState = self.model.TakeExpanded()
+        if self.expansionState is not None:
+            # expanding loads the branches below, so repeat until they are all in
+            self.SetExpansionState( self.expansionState )
+            if not self.model.IsLoading():
+                self.expansionState = None
+
+    def GetItemIdentity(self, item):
+        # ExpansionState keys items by taskid, which survives adds and moves above them
+        return self.model.GetItemId( self.GetIndexOfItem( item ) )
+
+    def SaveView(self):
+        self.model.SaveView( set( self.GetExpansionState() ) )
+
     def OnGetItemText( self, indices ):
         return self.model.GetText( indices )
 
@@ -89,9 +456,25 @@ class TaskTree(treemixin.VirtualTree, treemixin.DragAndDrop,
     def OnDrop(self, target, item):
         itemId   = self.model.GetItemId( self.GetIndexOfItem( item ) )
         targetId = self.model.GetItemId( self.GetIndexOfItem( target ) )
-        self.model.Move( itemId, targetId )
+        if wx.GetKeyState( wx.WXK_SHIFT ):
+            # shift-drop reorders, placing the item just above the target
+            self.model.Move( itemId, self.model.GetParentId( targetId ), targetId )
+        else:
+            self.model.Move( itemId, targetId )
         self.GetParent().RefreshItems()
 
+    def OnBeginEdit(self, event):
+        # the label carries the [open/total] badge, the editor should only hold the name;
+        # the edit control only exists once this event has been handled
+        name = self.model.GetItem( self.GetIndexOfItem( event.GetItem() ) ).name
+        wx.CallAfter( self.SetEditText, name )
+
+    def SetEditText(self, text):
+        control = self.GetEditControl() if self else None
+        if control:
+            control.SetValue( text )
+            control.SelectAll()
+
     def OnEndEdit(self, event):
         self.OnEdit( event.GetItem(), event.GetLabel() )
         self.GetParent().RefreshItems()
@@ -142,13 +525,13 @@ class TaskTree(treemixin.VirtualTree, treemixin.DragAndDrop,
 #--------------------------------------------------------------
 class TaskOverviewPanel(wx.Panel):
     def __init__(self, *args, **kwds):
-        self.taskbook = kwds.pop('taskbook')
+        self.worker = kwds.pop('worker')
         wx.Panel.__init__( self, *args, **kwds )
 
         self.newTaskText = wx.TextCtrl(self, -1, "", style=wx.TE_PROCESS_ENTER)
         self.newTaskText.Bind( wx.EVT_TEXT_ENTER, self.OnTaskEnter )
 
-        self.taskTree = TaskTree(self, taskbook=self.taskbook)
+        self.taskTree = TaskTree(self, worker=self.worker)
 
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(self.newTaskText, 0, wx.EXPAND, 0)
@@ -159,15 +542,14 @@ class TaskOverviewPanel(wx.Panel):
         self.newTaskText.SetFocus()
 
     def ReadConfig(self):
+        # the expansion state moved into the database, see TaskModel.SaveView
         config = GetConfig()
-        val = config.Read( 'ExpansionState' )
-        if val:
-            self.taskTree.SetExpansionState( eval(val) )
+        if config.HasEntry( 'ExpansionState' ):
+            config.DeleteEntry( 'ExpansionState' )
+            config.Flush()
 
     def SaveConfig(self):
-        config = GetConfig()
-        config.Write( 'ExpansionState', str(self.taskTree.GetExpansionState()) )
-        config.Flush()
+        self.taskTree.SaveView()
 
     def OnFocus(self, event):
         self.newTaskText.SetFocus()
@@ -175,12 +557,12 @@ class TaskOverviewPanel(wx.Panel):
     def OnTaskEnter(self, event):
         text = self.newTaskText.GetValue().strip()
         if len(text):
-            self.taskbook.add( text )
+            self.taskTree.model.Add( text )
         self.newTaskText.Clear()
         self.RefreshItems()
 
     def RefreshItems(self):
-        self.taskbook.refresh()
+        self.taskTree.model.Sync()
         self.taskTree.RefreshItems()
         self.taskTree.UnselectAll() 
 
@@ -239,11 +621,11 @@ class MyTaskBarIcon(wx.TaskBarIcon):
 class MyFrame2(wx.Frame):
     def __init__(self, *args, **kwds):
         kwds["style"] = wx.DEFAULT_FRAME_STYLE
-        self.taskbook = kwds.pop('taskbook')
+        self.worker = kwds.pop('worker')
         wx.Frame.__init__(self, *args, **kwds)
         self.notebook = wx.Notebook(self, -1, style=0)
 
-        self.notebook_pane_1 = TaskOverviewPanel(self.notebook, -1, taskbook=self.taskbook)
+        self.notebook_pane_1 = TaskOverviewPanel(self.notebook, -1, worker=self.worker)
         self.notebook_pane_2 = MessagePanel(self.notebook, -1)
 
         self.SetTitle("Tasks")
@@ -261,6 +643,7 @@ class MyFrame2(wx.Frame):
         self.notebook_pane_1.SaveConfig()
         if self.taskbar:
             self.taskbar.Destroy()
+        self.worker.Stop()
         self.Destroy()
 
     def __do_layout(self):
@@ -282,10 +665,9 @@ if __name__ == "__main__":
     app = wx.PySimpleApp(0)
     app.SetAppName( "jfs-tasks" )
     wx.InitAllImageHandlers()
-    database = task.Database()
-    taskbook = task.Taskbook( database )
-    taskbook.refresh()
-    frame = MyFrame2(None,-1,"",taskbook=taskbook)
+    worker = TaskWorker()
+    worker.start()
+    frame = MyFrame2(None,-1,"",worker=worker)
     app.SetTopWindow(frame)
     frame.Show()
     app.MainLoop()
@@ -4,17 +4,55 @@ import sys
 import os.path
 import logging
 import sqlite3
+import bisect
+import datetime
+import array
+import contextlib
+import itertools
+import collections
+import random
+import time
+
+# json, csv, socket and the daemon module are imported by the commands that
+# need them, to keep startup of the common commands short.
 
 #--------------------------------------------------------------------------
 def GetConfigDir():
-    cfgDir = os.path.join( os.environ['LOCALAPPDATA'], 'jfs-tasks' )
+    if 'LOCALAPPDATA' in os.environ:
+        base = os.environ['LOCALAPPDATA']
+    else:
+        # XDG base directory spec
+        base = os.environ.get( 'XDG_DATA_HOME' ) or os.path.join( os.path.expanduser( '~' ), '.local', 'share' )
+    cfgDir = os.path.join( base, 'jfs-tasks' )
     if not os.path.exists( cfgDir ):
         os.makedirs( cfgDir )
     return cfgDir
 
+#--------------------------------------------------------------------------
+# Names callers may put into SQL. Projections are checked against these instead
+# of being formatted in blindly, and each projection's SQL is built once so the
+# text, and with it the connection's prepared statement, is reused.
+TABLES = ( 'Status', 'Task', 'Message', 'MessageDaily', 'Change', 'ChangeHorizon', 'Backup', 'ViewState' )
+TASK_COLUMNS = ( 'taskid', 'name', 'details', 'parent', 'statusid', 'position', 'path', 'depth' )
+MESSAGE_COLUMNS = ( 'msgid', 'date', 'ts', 'text' )
+
+_projections = {}
+
+def _projection( columns, allowed ):
+    columns = tuple( columns )
+    projection = _projections.get( ( columns, allowed ) )
+    if projection is None:
+        for column in columns:
+            if column not in allowed:
+                raise sqlite3.OperationalError( "no such column: %r" % ( column, ) )
+        projection = _projections[ ( columns, allowed ) ] = ','.join( columns )
+    return projection
+
 #--------------------------------------------------------------------------
 def _dump_table( db, out, table ):
     try:
+        if table not in TABLES:
+            raise sqlite3.OperationalError( "no such table: %r" % ( table, ) )
         out.write( "%s Table:\n" % (table) )
         cursor = db.cursor()
         cursor.execute( "SELECT * FROM %s" % (table) )
@@ -24,10 +62,251 @@ def _dump_table( db, out, table ):
     except sqlite3.Error as e:
         logging.error( "Error dumping table %s: error=%s", table, str(e.args[0]) )
 
+#--------------------------------------------------------------------------
+def _path_range( path ):
+    # Every path in a subtree sorts between '/a/b/' and '/a/b0' since '/' < '0'
+    return ( path, path[:-1] + '0' )
+
+#--------------------------------------------------------------------------
+class Profiler(object):
+    """
+    Call counts, wall-time histograms and rows read/written for the Database,
+    table and Taskbook methods, plus the same per SQL statement. Nothing is
+    wrapped until a profiler is handed to Database, so normal runs pay nothing.
+    """
+    buckets = ( 0.1, 1, 10, 100, 1000 ) # histogram upper bounds in ms, plus one open bucket
+    skip = set([ 'debug', 'connection', 'cursor', 'transaction', 'batch', 'data_version' ])
+
+    def __init__( self ):
+        self._connection = None
+        self._read = 0  # rows fetched so far, methods report the difference
+        self._active = {} # { method: nesting level }, recursion is timed once
+        self._keys = {}
+        self.reset()
+
+    def reset( self ):
+        self.calls = {}      # { 'Class.method': [ calls, seconds, max seconds, read, written, histogram ] }
+        self.statements = {} # { sql: same }
+
+    def _entry( self, table, key ):
+        entry = table.get( key )
+        if entry is None:
+            entry = table[ key ] = [ 0, 0.0, 0.0, 0, 0, [ 0 ] * ( len(self.buckets) + 1 ) ]
+        return entry
+
+    def _record( self, table, key, seconds, read, written ):
+        entry = self._entry( table, key )
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max( entry[2], seconds )
+        entry[3] += read
+        entry[4] += written
+        entry[5][ bisect.bisect_left( self.buckets, seconds * 1000 ) ] += 1
+        return entry
+
+    def _changes( self ):
+        return self._connection.total_changes if self._connection else 0
+
+    def _key( self, sql ):
+        # one entry per statement shape, whatever the length of its IN lists
+        key = self._keys.get( sql )
+        if key is None:
+            import re
+            key = self._keys[ sql ] = re.sub( r"\?(\s*,\s*\?)+", "?,...", ' '.join( sql.split() ) )
+        return key
+
+    def statement( self, sql, seconds, read=0, written=0 ):
+        self._read += read
+        return self._record( self.statements, self._key( sql ), seconds, read, written )
+
+    def fetched( self, entry, seconds, read ):
+        # rows stepped after execute() belong to the statement that produced them
+        self._read += read
+        entry[1] += seconds
+        entry[3] += read
+
+    def connection( self, connection ):
+        """Return connection wrapped so every statement is timed."""
+        self._connection = connection
+        return ProfiledConnection( connection, self )
+
+    def instrument( self, obj ):
+        """Wrap the methods of obj with timing, on the instance only."""
+        import inspect
+        seen = set()
+        for klass in type( obj ).__mro__[:-1]:
+            for name, func in klass.__dict__.items():
+                if name in seen or name in self.skip or name.startswith( '__' ) or not inspect.isfunction( func ):
+                    continue
+                seen.add( name )
+                key = "%s.%s" % ( klass.__name__, name )
+                method = getattr( obj, name )
+                if inspect.isgeneratorfunction( func ):
+                    setattr( obj, name, self._wrap_generator( key, method ) )
+                else:
+                    setattr( obj, name, self._wrap( key, method ) )
+
+    def _enter( self, key ):
+        depth = self._active.get( key, 0 )
+        self._active[ key ] = depth + 1
+        return depth, self._read, self._changes(), time.time()
+
+    def _exit( self, key, state ):
+        depth, read, written, start = state
+        self._active[ key ] = depth
+        if depth:
+            self._entry( self.calls, key )[0] += 1
+        else:
+            self._record( self.calls, key, time.time() - start, self._read - read, self._changes() - written )
+
+    def _wrap( self, key, method ):
+        def timed( *args, **kwargs ):
+            state = self._enter( key )
+            try:
+                return method( *args, **kwargs )
+            finally:
+                self._exit( key, state )
+        return timed
+
+    def _wrap_generator( self, key, method ):
+        # time the whole iteration, not just creating the generator
+        def timed( *args, **kwargs ):
+            state = self._enter( key )
+            try:
+                for item in method( *args, **kwargs ):
+                    yield item
+            finally:
+                self._exit( key, state )
+        return timed
+
+    def dump( self ):
+        """Return the counters as plain data, for JSON."""
+        def rows( table ):
+            return [ dict( name=key, calls=calls, seconds=seconds, max_seconds=longest, read=read, written=written,
+                           histogram=histogram )
+                     for key, ( calls, seconds, longest, read, written, histogram ) in
+                     sorted( table.iteritems(), key=lambda item: -item[1][1] ) ]
+        return { 'buckets_ms': list( self.buckets ), 'calls': rows( self.calls ), 'statements': rows( self.statements ) }
+
+    def report( self, out, limit=None ):
+        header = "%10s %10s %9s %9s %9s %8s  %-23s %s\n" % ( 'calls', 'total ms', 'mean ms', 'max ms', 'read', 'written',
+                                                            ' '.join( '%-3g' % b for b in self.buckets ) + ' +', 'name' )
+        for title, table in ( ( "Methods", self.calls ), ( "SQL statements", self.statements ) ):
+            out.write( "%s:\n" % title )
+            out.write( header )
+            for key, ( calls, seconds, longest, read, written, histogram ) in \
+                    sorted( table.iteritems(), key=lambda item: -item[1][1] )[:limit]:
+                out.write( "%10u %10.2f %9.3f %9.3f %9u %8u  %-23s %s\n" % (
+                    calls, seconds * 1000, seconds * 1000 / calls, longest * 1000, read, written,
+                    ' '.join( '%-3u' % count for count in histogram ), key ) )
+            out.write( "\n" )
+
+#--------------------------------------------------------------------------
+class ProfiledConnection(object):
+    """sqlite3 connection stand-in that times statements, Python 2 has no trace callback."""
+    def __init__( self, connection, profiler ):
+        self._connection = connection
+        self._profiler = profiler
+
+    def __getattr__( self, name ):
+        return getattr( self._connection, name )
+
+    def cursor( self ):
+        return ProfiledCursor( self._connection.cursor(), self._profiler )
+
+    def execute( self, sql, parameters=() ):
+        return self.cursor().execute( sql, parameters )
+
+    def executemany( self, sql, parameters ):
+        return self.cursor().executemany( sql, parameters )
+
+#--------------------------------------------------------------------------
+class ProfiledCursor(object):
+    def __init__( self, cursor, profiler ):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._entry = None
+
+    def __getattr__( self, name ):
+        return getattr( self._cursor, name )
+
+    @property
+    def row_factory( self ):
+        return self._cursor.row_factory
+
+    @row_factory.setter
+    def row_factory( self, factory ):
+        self._cursor.row_factory = factory
+
+    def _run( self, method, sql, parameters ):
+        start = time.time()
+        method( sql, parameters )
+        self._entry = self._profiler.statement( sql, time.time() - start, written=max( self._cursor.rowcount, 0 ) )
+        return self
+
+    def execute( self, sql, parameters=() ):
+        return self._run( self._cursor.execute, sql, parameters )
+
+    def executemany( self, sql, parameters ):
+        return self._run( self._cursor.executemany, sql, parameters )
+
+    def _fetched( self, start, count ):
+        if self._entry is not None:
+            self._profiler.fetched( self._entry, time.time() - start, count )
+
+    def fetchone( self ):
+        start = time.time()
+        row = self._cursor.fetchone()
+        self._fetched( start, 0 if row is None else 1 )
+        return row
+
+    def fetchmany( self, size=None ):
+        start = time.time()
+        rows = self._cursor.fetchmany( size or self._cursor.arraysize )
+        self._fetched( start, len(rows) )
+        return rows
+
+    def fetchall( self ):
+        start = time.time()
+        rows = self._cursor.fetchall()
+        self._fetched( start, len(rows) )
+        return rows
+
+    def __iter__( self ):
+        return self
+
+    def next( self ):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+#--------------------------------------------------------------------------
+class TaskRecord(object):
+    """One cached task. Slotted, with kids as an array of taskids, to keep big books small."""
+    __slots__ = ( 'taskid', 'name', 'details', 'parent', 'statusid', 'kids', 'count', 'position' )
+
+    def __init__( self, taskid, name, details, parent, statusid, count=0, position=None ):
+        self.taskid = taskid
+        self.name = name
+        self.details = details
+        self.parent = parent
+        self.statusid = statusid
+        self.kids = array.array( 'l' ) # taskids in sibling order, filled in by Taskbook
+        self.count = count             # child count when loaded without kids
+        self.position = position       # sort key among its siblings
+
+    def __repr__( self ):
+        return "TaskRecord(%r, %r, parent=%r, kids=%r)" % ( self.taskid, self.name, self.parent, list( self.kids ) )
+
 #--------------------------------------------------------------------------
 class TaskTable(object):
     def __init__( self, db ):
         self._database = db
+        self._hierarchy = False # Task.path/Task.depth maintained by triggers
+        self._statuses = None   # [ ( statusid, name, short ) ], read once
+        self._statusids = {}    # { name or short: statusid }
+        self.rebalances = 0     # sibling renumbers, a cached copy of the positions is stale after one
 
     def create_status_table( self ):
         columns = [
@@ -41,7 +320,7 @@ class TaskTable(object):
             ( 3, 'Withdrawn', 'W' )
         ]
         try:
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 conn.execute( "CREATE TABLE IF NOT EXISTS Status ( %s )" % (','.join(columns)) )
                 conn.executemany( "INSERT or IGNORE INTO Status ( statusid, name, short ) VALUES (?,?,?)", values )
         except sqlite3.Error as e:
@@ -57,33 +336,210 @@ class TaskTable(object):
             "FOREIGN KEY(statusid) REFERENCES Status(statusid)"
         ]
         try:
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 conn.execute( "CREATE TABLE IF NOT EXISTS Task ( %s )" % (','.join(columns)) )
         except sqlite3.Error as e:
             logging.error( "Failed to initialize Task table: %s", str( e.args[0] ) )
 
+    def create_hierarchy( self ):
+        """Add the materialized path index to the Task table, filling it for existing rows."""
+        triggers = [
+            # path is '/root/.../taskid/', depth is the number of ancestors
+            "CREATE TRIGGER IF NOT EXISTS TaskPathInsert AFTER INSERT ON Task BEGIN"
+            "  UPDATE Task SET"
+            "    path=COALESCE( (SELECT path FROM Task WHERE taskid=NEW.parent), '/' ) || NEW.taskid || '/',"
+            "    depth=COALESCE( (SELECT depth+1 FROM Task WHERE taskid=NEW.parent), 0 )"
+            "  WHERE taskid=NEW.taskid;"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS TaskPathCycle BEFORE UPDATE OF parent ON Task"
+            " WHEN (SELECT substr( path, 1, length(OLD.path) ) FROM Task WHERE taskid=NEW.parent) = OLD.path BEGIN"
+            "  SELECT RAISE( ABORT, 'task cannot be moved below itself' );"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS TaskPathMove AFTER UPDATE OF parent ON Task"
+            " WHEN NEW.parent IS NOT OLD.parent BEGIN"
+            "  UPDATE Task SET"
+            "    path=COALESCE( (SELECT path FROM Task WHERE taskid=NEW.parent), '/' ) || NEW.taskid || '/' || substr( path, length(OLD.path)+1 ),"
+            "    depth=depth - OLD.depth + COALESCE( (SELECT depth+1 FROM Task WHERE taskid=NEW.parent), 0 )"
+            "  WHERE path >= OLD.path AND path < substr( OLD.path, 1, length(OLD.path)-1 ) || '0';"
+            " END"
+        ]
+        try:
+            with self._database.transaction() as conn:
+                columns = [ row[1] for row in conn.execute( "PRAGMA table_info(Task)" ) ]
+                if 'path' not in columns:
+                    conn.execute( "ALTER TABLE Task ADD COLUMN path TEXT" )
+                    conn.execute( "ALTER TABLE Task ADD COLUMN depth INTEGER" )
+                # new columns, or cleared by drop_hierarchy
+                migrate = conn.execute( "SELECT EXISTS ( SELECT 1 FROM Task WHERE path IS NULL )" ).fetchone()[0]
+                # statusid makes subtree status counts index-only
+                conn.execute( "CREATE INDEX IF NOT EXISTS TaskPathStatus ON Task ( path, statusid )" )
+                conn.execute( "DROP INDEX IF EXISTS TaskPath" )
+                for trigger in triggers:
+                    conn.execute( trigger )
+            if migrate:
+                self.rebuild_hierarchy()
+            self._hierarchy = True
+        except sqlite3.Error as e:
+            logging.error( "Failed to initialize Task hierarchy: %s", str( e.args[0] ) )
+
+    def drop_hierarchy( self ):
+        """
+        Remove the path index again: its triggers and index go and the columns are
+        cleared, so the space they took is reused. Other open connections keep
+        using the index until they reconnect.
+        """
+        try:
+            with self._database.transaction() as conn:
+                for trigger in ( 'TaskPathInsert', 'TaskPathCycle', 'TaskPathMove' ):
+                    conn.execute( "DROP TRIGGER IF EXISTS %s" % trigger )
+                conn.execute( "DROP INDEX IF EXISTS TaskPathStatus" )
+                if self._hierarchy:
+                    conn.execute( "UPDATE Task SET path=NULL, depth=NULL" )
+            self._hierarchy = False
+            return True
+        except sqlite3.Error as e:
+            logging.error( "Failed to drop Task hierarchy: %s", str( e.args[0] ) )
+            return False
+
+    def _rebuild_hierarchy( self, conn ):
+        conn.execute( "DROP TABLE IF EXISTS temp.TaskLinks" )
+        conn.execute( "DROP TABLE IF EXISTS temp.TaskPaths" )
+        conn.execute( "CREATE TEMP TABLE TaskLinks ( taskid INTEGER PRIMARY KEY, parent INTEGER )" )
+        conn.execute( "CREATE TEMP TABLE TaskPaths ( taskid INTEGER PRIMARY KEY, path TEXT, depth INTEGER )" )
+        conn.execute( "INSERT INTO TaskLinks SELECT taskid, parent FROM Task" )
+        conn.execute( "CREATE INDEX temp.TaskLinksParent ON TaskLinks ( parent )" )
+        # Tasks stuck in a parent cycle are unreachable from any root and keep a NULL path
+        conn.execute( "INSERT INTO TaskPaths WITH RECURSIVE tree(taskid, path, depth) AS ("
+                      "  SELECT taskid, '/' || taskid || '/', 0 FROM TaskLinks"
+                      "   WHERE parent IS NULL OR parent NOT IN ( SELECT taskid FROM TaskLinks )"
+                      "  UNION ALL SELECT TaskLinks.taskid, tree.path || TaskLinks.taskid || '/', tree.depth+1"
+                      "   FROM TaskLinks JOIN tree ON TaskLinks.parent=tree.taskid"
+                      ") SELECT * FROM tree" )
+        conn.execute( "UPDATE Task SET"
+                      "  path=(SELECT path FROM TaskPaths WHERE TaskPaths.taskid=Task.taskid),"
+                      "  depth=(SELECT depth FROM TaskPaths WHERE TaskPaths.taskid=Task.taskid)" )
+        conn.execute( "DROP TABLE temp.TaskLinks" )
+        conn.execute( "DROP TABLE temp.TaskPaths" )
+
+    def rebuild_hierarchy( self ):
+        """Recompute every Task.path and Task.depth from the parent column."""
+        try:
+            with self._database.transaction() as conn:
+                self._rebuild_hierarchy( conn )
+            return True
+        except sqlite3.Error as e:
+            logging.error( "Failed to rebuild Task hierarchy: %s", str( e.args[0] ) )
+            return False
+
     def create( self ):
         self.create_status_table()
         self.create_task_table()
+        try:
+            # the columns outlive drop_hierarchy, the triggers do not
+            self._hierarchy = bool( self._database.cursor().execute(
+                "SELECT EXISTS ( SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='TaskPathMove' )" ).fetchone()[0] )
+        except sqlite3.Error as e:
+            logging.error( "Failed to inspect Task table: %s", str( e.args[0] ) )
+
+    @property
+    def hierarchy( self ):
+        return self._hierarchy
 
     def debug( self, out ):
         _dump_table( self._database, out, "Task" )
         _dump_table( self._database, out, "Status" )
 
-    def select( self, columns=["taskid","name","details","parent","statusid"] ):
+    def select( self, columns=TASK_COLUMNS[:5], row_factory=None ):
+        """
+        Return every task as a dict of columns, ordered by taskid. row_factory,
+        e.g. sqlite3.Row, builds the rows instead and is much cheaper than dicts.
+        """
         try:
             cursor = self._database.cursor()
-            cursor.execute( "SELECT %s FROM Task" % (','.join( columns )) )
+            cursor.execute( "SELECT %s FROM Task ORDER BY taskid" % _projection( columns, TASK_COLUMNS ) )
+            if row_factory is not None:
+                cursor.row_factory = row_factory
+                return cursor.fetchall()
             return [ dict( zip( columns, row ) ) for row in cursor ]
         except sqlite3.Error as e:
             logging.error( "Error getting tasks: columns=%s error=%s", str(columns), str(e.args[0]) )
             return None
 
+    def fetch( self, ids ):
+        """Return TaskRecords for those of ids that still exist."""
+        ids = list( ids )
+        records = []
+        try:
+            cursor = self._database.cursor()
+            for start in xrange( 0, len(ids), 500 ):
+                chunk = ids[ start:start+500 ]
+                cursor.execute( "SELECT taskid, name, details, parent, statusid, 0, position FROM Task WHERE taskid IN (%s)"
+                                % ','.join( '?' * len(chunk) ), chunk )
+                records.extend( TaskRecord( *row ) for row in cursor )
+            return records
+        except sqlite3.Error as e:
+            logging.error( "Error fetching tasks: %s", str( e.args[0] ) )
+            return None
+
+    def records( self ):
+        """Yield every task as a TaskRecord, ordered by taskid."""
+        cursor = self._database.cursor()
+        cursor.execute( "SELECT taskid, name, details, parent, statusid, 0, position FROM Task ORDER BY taskid" )
+        for row in cursor:
+            yield TaskRecord( *row )
+
+    def children( self, parentid ):
+        """Return the direct children of parentid (None for top level) in order, as TaskRecords with child counts."""
+        try:
+            cursor = self._database.cursor()
+            cursor.execute( "SELECT taskid, name, details, parent, statusid,"
+                            "  (SELECT COUNT(*) FROM Task AS kid WHERE kid.parent=Task.taskid), position"
+                            " FROM Task WHERE parent IS ? ORDER BY position, taskid", (parentid,) )
+            return [ TaskRecord( *row ) for row in cursor ]
+        except sqlite3.Error as e:
+            logging.error( "Error getting task children: parent=%s error=%s", str(parentid), str(e.args[0]) )
+            return None
+
+    def iterate( self ):
+        """
+        Yield ( taskid, parent, statusid, name, details ) rows straight from the cursor,
+        siblings in order so a load() appends them back the same way.
+        """
+        cursor = self._database.cursor()
+        cursor.execute( "SELECT taskid, parent, statusid, name, details FROM Task ORDER BY position, taskid" )
+        for row in cursor:
+            yield row
+
+    def statuses( self ):
+        """Return the ( statusid, name, short ) rows of the Status table."""
+        if self._statuses is None:
+            try:
+                self._statuses = self._database.cursor().execute( "SELECT statusid, name, short FROM Status ORDER BY statusid" ).fetchall()
+                for statusid, name, short in self._statuses:
+                    self._statusids[ name ] = statusid
+                    self._statusids[ short ] = statusid
+            except sqlite3.Error as e:
+                logging.error( "Error getting statuses: %s", str( e.args[0] ) )
+                return []
+        return self._statuses
+
+    def statusid( self, status ):
+        """Return the statusid for a status name or short code, None if unknown."""
+        self.statuses()
+        return self._statusids.get( status )
+
+    def _statusid( self, status ):
+        statusid = self.statusid( status )
+        if statusid is None:
+            raise sqlite3.IntegrityError( "unknown status '%s'" % status )
+        return statusid
+
     def insert( self, name, details="", status='O' ):
         try:
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 cursor = conn.cursor()
-                cursor.execute( "INSERT INTO Task ( name, details ) VALUES ( ?, ? )", ( name, details ) )
+                cursor.execute( "INSERT INTO Task ( name, details, statusid ) VALUES ( ?, ?, ? )",
+                                ( name, details, self._statusid( status ) ) )
             return cursor.lastrowid
         except sqlite3.Error as e:
             logging.error( "Failed to insert new task: %s", str( e.args[0] ) )
@@ -91,7 +547,7 @@ class TaskTable(object):
 
     def update( self, taskid, name ):
         try:
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute( "UPDATE Task SET name=? WHERE taskid=?", (name, taskid) )
             return True
@@ -101,7 +557,7 @@ class TaskTable(object):
 
     def delete( self, ids ):
         try:
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.executemany( "DELETE FROM Task WHERE taskid=?", [ (id,) for id in ids ] )
             return True
@@ -109,20 +565,275 @@ class TaskTable(object):
             logging.error( "Failed to delete tasks: ids=%s error=%s", str(ids), str(e.args[0]) )
             return False
 
-    def set_parent( self, taskid, parent ):
+    def _path( self, cursor, taskid ):
+        if not self._hierarchy:
+            return None
+        row = cursor.execute( "SELECT path FROM Task WHERE taskid=?", (taskid,) ).fetchone()
+        return row[0] if row else None
+
+    def delete_subtree( self, taskid ):
+        """Delete a task and all of its descendants, returning the number of rows removed."""
         try:
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 cursor = conn.cursor()
-                cursor.execute( "UPDATE Task SET parent=? WHERE taskid=?", (parent, taskid) )
+                path = self._path( cursor, taskid )
+                if path:
+                    cursor.execute( "DELETE FROM Task WHERE path >= ? AND path < ?", _path_range( path ) )
+                else:
+                    cursor.execute( "WITH RECURSIVE subtree(taskid) AS ("
+                                    "  SELECT ? UNION SELECT Task.taskid FROM Task JOIN subtree ON Task.parent=subtree.taskid"
+                                    ") DELETE FROM Task WHERE taskid IN subtree", (taskid,) )
+                # cursor.rowcount is not set for statements starting with WITH
+                count = cursor.execute( "SELECT changes()" ).fetchone()[0]
+            return count
+        except sqlite3.Error as e:
+            logging.error( "Failed to delete task subtree: taskid=%s error=%s", str(taskid), str(e.args[0]) )
+            return None
+
+    def set_status( self, taskid, status ):
+        """Set a task's status by short code or name, e.g. 'C' or 'Closed'."""
+        try:
+            with self._database.transaction() as conn:
+                statusid = self._statusid( status )
+                conn.execute( "UPDATE Task SET statusid=? WHERE taskid=?", (statusid, taskid) )
+            return statusid
+        except sqlite3.Error as e:
+            logging.error( "Failed to set task[%s] status: %s", taskid, str( e.args[0] ) )
+            return None
+
+    def set_parent( self, taskid, parent, before=None ):
+        """
+        Move taskid below parent, just ahead of the sibling before or last when None.
+        Returns the task's new position, or None on error.
+        """
+        try:
+            with self._database.transaction() as conn:
+                cursor = conn.cursor()
+                if parent is not None:
+                    ancestors = self._ancestors( cursor, parent )
+                    if not ancestors:
+                        raise sqlite3.IntegrityError( "no such task %s" % parent )
+                    # With the hierarchy index the TaskPathCycle trigger rejects cycles instead
+                    if not self._hierarchy and taskid in ancestors:
+                        raise sqlite3.IntegrityError( "task cannot be moved below itself" )
+                position = self._position( cursor, taskid, parent, before )
+                cursor.execute( "UPDATE Task SET parent=?, position=? WHERE taskid=?", (parent, position, taskid) )
+                if not cursor.rowcount:
+                    raise sqlite3.IntegrityError( "no such task %s" % taskid )
+            return position
+        except sqlite3.Error as e:
+            logging.error( "Failed to set task[%s] as parent to task[%s]: %s", parent, taskid, str( e.args[0] ) )
+            return None
+
+    def _position( self, cursor, taskid, parent, before ):
+        # Siblings are ordered by a REAL position, so a task goes between two of them by
+        # taking the midpoint, one row written. Only once the floats between two
+        # neighbours run out are the siblings renumbered.
+        if before is None:
+            return ( self._last_position( cursor, taskid, parent ) or 0 ) + 1
+        if before == taskid:
+            raise sqlite3.IntegrityError( "task cannot be placed before itself" )
+        row = cursor.execute( "SELECT position FROM Task WHERE taskid=? AND parent IS ?", (before, parent) ).fetchone()
+        if row is None:
+            raise sqlite3.IntegrityError( "task %s is not below task %s" % ( before, parent ) )
+        upper = row[0]
+        lower = self._last_position( cursor, taskid, parent, upper )
+        if lower is None:
+            return upper - 1
+        position = ( lower + upper ) / 2.0
+        if not lower < position < upper:
+            self._rebalance( cursor, parent )
+            return self._position( cursor, taskid, parent, before )
+        return position
+
+    def _last_position( self, cursor, taskid, parent, below=None ):
+        # Highest position among parent's kids other than taskid, below `below` when
+        # given. Read off the end of TaskParentPosition; a taskid<>? filter in the
+        # query would turn that into a scan of all the kids.
+        cursor.execute( "SELECT taskid, position FROM Task WHERE parent IS ? AND position < COALESCE( ?, 1e308 )"
+                        " ORDER BY position DESC LIMIT 2", (parent, below) )
+        for kid, position in cursor.fetchall():
+            if kid != taskid:
+                return position
+        return None
+
+    def _rebalance( self, cursor, parent ):
+        cursor.execute( "SELECT taskid FROM Task WHERE parent IS ? ORDER BY position, taskid", (parent,) )
+        positions = [ ( n, row[0] ) for n, row in enumerate( cursor.fetchall(), 1 ) ]
+        cursor.executemany( "UPDATE Task SET position=? WHERE taskid=?", positions )
+        self.rebalances += 1
+
+    def rebalance( self, parent ):
+        """Renumber the positions of parent's kids 1, 2, 3... keeping their order."""
+        try:
+            with self._database.transaction() as conn:
+                self._rebalance( conn.cursor(), parent )
             return True
         except sqlite3.Error as e:
-            logging.error( "Failed to set task[%u] as parent to task[%u]", parent, taskid )
+            logging.error( "Failed to rebalance kids of task[%s]: %s", parent, str( e.args[0] ) )
             return False
 
+    def _ancestors( self, cursor, taskid ):
+        # [ root, ..., taskid ]
+        path = self._path( cursor, taskid )
+        if path:
+            return [ int(id) for id in path.strip('/').split('/') ]
+        # UNION rather than a depth cap ends the walk, even at a cycle, so however
+        # deep the book the whole chain comes back
+        cursor.execute( "WITH RECURSIVE chain(taskid, parent) AS ("
+                        "  SELECT taskid, parent FROM Task WHERE taskid=?"
+                        "  UNION SELECT Task.taskid, Task.parent FROM Task JOIN chain ON Task.taskid=chain.parent"
+                        ") SELECT taskid, parent FROM chain", (taskid,) )
+        parents = dict( cursor.fetchall() )
+        chain = []
+        while taskid in parents and len( chain ) < len( parents ):
+            chain.append( taskid )
+            taskid = parents[ taskid ]
+        chain.reverse()
+        return chain
+
+    def ancestors( self, taskid ):
+        """Return the ids on the path from the root down to taskid, inclusive."""
+        try:
+            return self._ancestors( self._database.cursor(), taskid )
+        except sqlite3.Error as e:
+            logging.error( "Error getting task ancestors: taskid=%s error=%s", str(taskid), str(e.args[0]) )
+            return None
+
+    def depth( self, taskid ):
+        """Return the number of ancestors of taskid, 0 for a top level task."""
+        path = self.ancestors( taskid )
+        if not path:
+            return None
+        return len( path ) - 1
+
+    def counts( self, taskid=None ):
+        """Return { statusid: count } for the tasks below taskid, or for the whole book when None."""
+        try:
+            cursor = self._database.cursor()
+            path = self._path( cursor, taskid ) if taskid is not None else None
+            if taskid is None:
+                cursor.execute( "SELECT statusid, COUNT(*) FROM Task GROUP BY statusid" )
+            elif path:
+                cursor.execute( "SELECT statusid, COUNT(*) FROM Task WHERE path > ? AND path < ? GROUP BY statusid",
+                                _path_range( path ) )
+            else:
+                cursor.execute( "WITH RECURSIVE subtree(taskid) AS ("
+                                "  SELECT taskid FROM Task WHERE parent=?"
+                                "  UNION SELECT Task.taskid FROM Task JOIN subtree ON Task.parent=subtree.taskid"
+                                ") SELECT statusid, COUNT(*) FROM Task WHERE taskid IN subtree GROUP BY statusid", (taskid,) )
+            return dict( cursor.fetchall() )
+        except sqlite3.Error as e:
+            logging.error( "Error counting tasks: taskid=%s error=%s", str(taskid), str(e.args[0]) )
+            return None
+
+    def walk( self, root=None, status=None, depth=None, limit=None ):
+        """
+        Yield ( taskid, name, level ) depth first, kids in sibling order, for the
+        tasks below root (the whole book when None). With status only matching
+        tasks are followed, so a task with another status hides its subtree.
+        depth limits the levels returned and limit the number of tasks.
+        """
+        statusid = self._statusid( status ) if status else None
+        cursor = self._database.cursor()
+        # ORDER BY level DESC makes the recursive queue a stack, i.e. depth first, and
+        # SQLite only expands the rows read, so a limit stops the walk early
+        cursor.execute( "WITH RECURSIVE tree(taskid, name, level, position) AS ("
+                        "  SELECT taskid, name, 0, position FROM Task WHERE parent IS :root AND ( :status IS NULL OR statusid=:status )"
+                        "   AND ( :depth IS NULL OR :depth > 0 )"
+                        "  UNION ALL SELECT Task.taskid, Task.name, tree.level+1, Task.position FROM tree JOIN Task ON Task.parent=tree.taskid"
+                        "   WHERE ( :status IS NULL OR Task.statusid=:status ) AND ( :depth IS NULL OR tree.level+1 < :depth )"
+                        "  ORDER BY 3 DESC, 4, 1 LIMIT :limit"
+                        ") SELECT taskid, name, level FROM tree",
+                        { 'root': root, 'status': statusid, 'depth': depth, 'limit': -1 if limit is None else limit } )
+        for row in cursor:
+            yield row
+
+    def descendants( self, taskid ):
+        """Return the ids of every task below taskid, excluding taskid itself."""
+        try:
+            cursor = self._database.cursor()
+            path = self._path( cursor, taskid )
+            if path:
+                cursor.execute( "SELECT taskid FROM Task WHERE path > ? AND path < ?", _path_range( path ) )
+            else:
+                cursor.execute( "WITH RECURSIVE subtree(taskid) AS ("
+                                "  SELECT taskid FROM Task WHERE parent=?"
+                                "  UNION SELECT Task.taskid FROM Task JOIN subtree ON Task.parent=subtree.taskid"
+                                ") SELECT taskid FROM subtree", (taskid,) )
+            return [ row[0] for row in cursor ]
+        except sqlite3.Error as e:
+            logging.error( "Error getting task descendants: taskid=%s error=%s", str(taskid), str(e.args[0]) )
+            return None
+
+#--------------------------------------------------------------------------
+class ChangeTable(object):
+    """
+    Change feed written by triggers: one row per Task or Message insert, update,
+    move or delete, numbered by a monotonic seq. Rows up to the horizon may have
+    been compacted away; readers that far behind have to reload instead.
+    """
+    columns = [ 'seq', 'tablename', 'op', 'id', 'parent', 'oldparent', 'ts' ]
+    _since = "SELECT %s FROM Change WHERE seq > ? AND tablename = COALESCE( ?, tablename ) ORDER BY seq LIMIT ?" % ','.join( columns )
+
+    def __init__( self, db ):
+        self._database = db
+
+    def debug( self, out ):
+        _dump_table( self._database, out, "Change" )
+        _dump_table( self._database, out, "ChangeHorizon" )
+
+    def last( self ):
+        """Return the newest seq, the starting point for a reader that is current now."""
+        try:
+            return self._database.cursor().execute(
+                "SELECT MAX( COALESCE( (SELECT MAX(seq) FROM Change), 0 ), (SELECT seq FROM ChangeHorizon) )" ).fetchone()[0]
+        except sqlite3.Error as e:
+            logging.error( "Error getting last change: %s", str( e.args[0] ) )
+            return None
+
+    def since( self, seq, limit=None, tablename=None ):
+        """
+        Return the changes after seq as dicts, oldest first, or None if they were
+        compacted away. With tablename only that table's changes are returned.
+        """
+        try:
+            cursor = self._database.cursor()
+            horizon = cursor.execute( "SELECT seq FROM ChangeHorizon" ).fetchone()[0]
+            if seq < horizon:
+                return None
+            cursor.execute( self._since, ( seq, tablename, -1 if limit is None else limit ) )
+            return [ dict( zip( self.columns, row ) ) for row in cursor ]
+        except sqlite3.Error as e:
+            logging.error( "Error getting changes: seq=%s error=%s", str(seq), str(e.args[0]) )
+            return None
+
+    def compact( self, seq=None ):
+        """Drop the changes up to and including seq (everything when None), returning how many went."""
+        try:
+            with self._database.transaction() as conn:
+                if seq is None:
+                    seq = conn.execute( "SELECT COALESCE( MAX(seq), 0 ) FROM Change" ).fetchone()[0]
+                conn.execute( "DELETE FROM Change WHERE seq <= ?", (seq,) )
+                count = conn.execute( "SELECT changes()" ).fetchone()[0]
+                conn.execute( "UPDATE ChangeHorizon SET seq=MAX( seq, ? )", (seq,) )
+            return count
+        except sqlite3.Error as e:
+            logging.error( "Failed to compact changes: %s", str( e.args[0] ) )
+            return None
+
 #--------------------------------------------------------------------------
 class MessageTable(object):
+    """
+    The message log. Old days can be moved out to monthly archive databases
+    (ArchiveDay rows holding a day's messages as zlib compressed JSON); the
+    MessageDaily rollup keeps covering them, and queries that reach archived
+    days unpack those days into a temp table and read it alongside Message.
+    """
     def __init__( self, db ):
         self._database = db
+        self._archives = collections.OrderedDict() # { 'YYYY-MM': connection to that month's archive }, oldest use first
+        self._unpacked = {} # { date: MessageDaily.archived } of the archived days in temp.ArchivedMessage
 
     def create( self ):
         columns = [
@@ -132,28 +843,109 @@ class MessageTable(object):
             'text TEXT'
         ]
         try:
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 conn.execute( "CREATE TABLE IF NOT EXISTS Message ( %s )" % (','.join(columns) ) )
         except sqlite3.Error as e:
             logging.error( "Failed to initialize Message table: %s", str( e.args[0] ) )
 
     def debug( self, out ):
         _dump_table( self._database, out, "Message" )
+        _dump_table( self._database, out, "MessageDaily" )
 
-    def select( self, columns=[ 'date', 'ts', 'text' ] ):
+    def select( self, columns=MESSAGE_COLUMNS[1:], since=None, until=None, limit=None, after_id=None, row_factory=None ):
         try:
-            cursor = self._database.cursor()
-            cursor.execute( "SELECT %s FROM Message" % (','.join(columns)) )
+            cursor = self._query( columns, since, until, limit, after_id )
+            if row_factory is not None:
+                cursor.row_factory = row_factory
+                return cursor.fetchall()
             return [ dict( zip( columns, row ) ) for row in cursor ]
         except sqlite3.Error as e:
             logging.error( "Error getting messages: colunns=%s error=%s", str(columns), str(e.args[0]) )
             return None
 
+    def iterate( self, columns=MESSAGE_COLUMNS, since=None, until=None, limit=None, after_id=None ):
+        """
+        Like select(), but yields row tuples lazily from the cursor. Without a page
+        to fill, archived days are read one at a time from their archive files and
+        merged in, instead of being unpacked into temp.ArchivedMessage.
+        """
+        try:
+            if limit is None and after_id is None:
+                rows = self._stream( columns, since, until )
+            else:
+                rows = self._query( columns, since, until, limit, after_id )
+            for row in rows:
+                yield row
+        except sqlite3.Error as e:
+            logging.error( "Error iterating messages: colunns=%s error=%s", str(columns), str(e.args[0]) )
+
+    def _query( self, columns, since, until, limit, after_id ):
+        # Messages come back in ( date, ts ) order straight off the MessageDateTs index.
+        # since/until are inclusive dates, after_id continues a previous page after that message.
+        archived = self._source( since, until, after_id, limit )
+        where, params = [], []
+        if since is not None:
+            where.append( "date >= ?" )
+            params.append( since )
+        if until is not None:
+            where.append( "date <= ?" )
+            params.append( until )
+        if after_id is not None:
+            where.append( "( date, ts, msgid ) > ( SELECT date, ts, msgid FROM %s WHERE msgid=? )" % self._union() )
+            params.append( after_id )
+        where = " WHERE " + " AND ".join( where ) if where else ""
+        order = " ORDER BY date, ts, msgid" + ( " LIMIT ?" if limit is not None else "" )
+        projection = _projection( columns, MESSAGE_COLUMNS )
+        if archived:
+            # each side is limited off its own index before the two are merged
+            side = "SELECT * FROM ( SELECT msgid, date, ts, text FROM %s" + where + order + " )"
+            sql = "SELECT %s FROM ( %s UNION ALL %s )%s" % ( projection, side % "temp.ArchivedMessage", side % "main.Message", order )
+            params = ( params + ( [ limit ] if limit is not None else [] ) ) * 2
+        else:
+            sql = "SELECT %s FROM Message%s%s" % ( projection, where, order )
+        if limit is not None:
+            params.append( limit )
+        cursor = self._database.cursor()
+        cursor.execute( sql, params )
+        return cursor
+
+    def _stream( self, columns, since, until ):
+        # Message and each archived day are both in ( date, ts, msgid ) order, so
+        # merging them keeps only one day's archive in memory at a time.
+        import heapq
+        import json
+        import zlib
+        _projection( columns, MESSAGE_COLUMNS )
+        indices = [ MESSAGE_COLUMNS.index( column ) for column in columns ]
+        where, params = [], []
+        if since is not None:
+            where.append( "date >= ?" )
+            params.append( since )
+        if until is not None:
+            where.append( "date <= ?" )
+            params.append( until )
+        where = " WHERE " + " AND ".join( where ) if where else ""
+        days = self._database.cursor().execute(
+            "SELECT date FROM MessageDaily WHERE archived AND date >= COALESCE( ?, date ) AND date <= COALESCE( ?, date ) ORDER BY date",
+            ( since, until ) ).fetchall()
+        live = self._database.cursor().execute( "SELECT date, ts, msgid, text FROM Message%s ORDER BY date, ts, msgid" % where, params )
+
+        def archived():
+            for date, in days:
+                row = self._archive( date[:7] ).execute( "SELECT data FROM ArchiveDay WHERE date=?", ( date, ) ).fetchone()
+                if row:
+                    for msgid, ts, text in json.loads( zlib.decompress( row[0] ) ):
+                        yield date, ts, msgid, text
+
+        for date, ts, msgid, text in heapq.merge( archived(), live ):
+            row = ( msgid, date, ts, text )
+            yield tuple( row[i] for i in indices )
+
     def insert( self, text ):
         try:
             today = datetime.date.today()
             now = datetime.datetime.now()
-            with self._database.connection() as conn:
+            with self._database.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute( "INSERT INTO Message ( date, ts, text ) VALUES ( ?, ?, ? )", ( today, now, text ) )
             return cursor.lastrowid
@@ -161,15 +953,379 @@ class MessageTable(object):
             logging.error( "Failed to insert new message: %s", str( e.args[0] ) )
             return None
 
+    def daily( self, since=None, until=None ):
+        """Return ( date, count, first ts, last ts, archived ) per day, archived days included."""
+        try:
+            cursor = self._database.cursor()
+            cursor.execute( "SELECT date, count, first, last, archived FROM MessageDaily"
+                            " WHERE date >= COALESCE( ?, date ) AND date <= COALESCE( ?, date ) ORDER BY date",
+                            ( since, until ) )
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error( "Error getting daily messages: %s", str( e.args[0] ) )
+            return None
+
+    def _archive( self, month ):
+        connection = self._archives.pop( month, None )
+        if connection is None:
+            while len( self._archives ) >= ARCHIVE_CONNECTIONS:
+                self._archives.popitem( last=False )[1].close()
+            folder = os.path.join( os.path.dirname( os.path.abspath( self._database.filename ) ), 'archive' )
+            if not os.path.exists( folder ):
+                os.makedirs( folder )
+            connection = sqlite3.connect( os.path.join( folder, 'messages-%s.db' % month ) )
+            connection.execute( "CREATE TABLE IF NOT EXISTS ArchiveDay ( date DATE PRIMARY KEY,"
+                                " count INTEGER, first TIMESTAMP, last TIMESTAMP, data BLOB )" )
+        self._archives[ month ] = connection
+        return connection
+
+    def _source( self, since, until, after_id, limit ):
+        # Whether to read temp.ArchivedMessage alongside Message. The archived days a
+        # query reaches are unpacked into that temp table, once per process.
+        # MessageDaily.archived counts how often a day was archived, so a day
+        # archived again since it was unpacked gets unpacked again.
+        cursor = self._database.cursor()
+        if after_id is not None:
+            # the page starts at after_id's day, which may itself be archived
+            self._unpack( cursor.execute( "SELECT date, archived FROM MessageDaily WHERE archived AND ? BETWEEN minid AND maxid",
+                                          ( after_id, ) ).fetchall() )
+            row = cursor.execute( "SELECT date FROM %s WHERE msgid=?" % self._union(), ( after_id, ) ).fetchone()
+            if row and ( since is None or row[0] > since ):
+                since = row[0]
+        cursor.execute( "SELECT date, archived, count FROM MessageDaily"
+                        " WHERE archived AND date >= COALESCE( ?, date ) AND date <= COALESCE( ?, date ) ORDER BY date",
+                        ( since, until ) )
+        days, count = [], 0
+        for date, archived, messages in cursor:
+            if limit is not None and count >= limit:
+                break # enough archived days to fill the page
+            days.append( ( date, archived ) )
+            if after_id is None or date != since:
+                count += messages # only part of after_id's own day is on the page
+        self._unpack( days )
+        return bool( self._unpacked )
+
+    def _union( self ):
+        if not self._unpacked:
+            return "Message"
+        return "( SELECT msgid, date, ts, text FROM temp.ArchivedMessage UNION ALL SELECT msgid, date, ts, text FROM main.Message )"
+
+    def _unpack( self, days ):
+        import json
+        import zlib
+        days = [ ( date, archived ) for date, archived in days if self._unpacked.get( date ) != archived ]
+        if not days:
+            return
+        conn = self._database.connection()
+        conn.execute( "CREATE TEMP TABLE IF NOT EXISTS ArchivedMessage ( msgid INTEGER PRIMARY KEY, date DATE, ts TIMESTAMP, text TEXT )" )
+        conn.execute( "CREATE INDEX IF NOT EXISTS temp.ArchivedMessageDateTs ON ArchivedMessage ( date, ts )" )
+        for date, archived in days:
+            row = self._archive( date[:7] ).execute( "SELECT data FROM ArchiveDay WHERE date=?", ( date, ) ).fetchone()
+            if row:
+                conn.executemany( "INSERT OR REPLACE INTO temp.ArchivedMessage ( msgid, date, ts, text ) VALUES ( ?, ?, ?, ? )",
+                                  [ ( msgid, date, ts, text ) for msgid, ts, text in json.loads( zlib.decompress( row[0] ) ) ] )
+            self._unpacked[ date ] = archived
+
+    def archive( self, before ):
+        """
+        Move the messages dated before `before` into the monthly archives, returning
+        ( days, messages ) moved or None on error. A day archived again, after late
+        inserts, is merged with what its archive already holds. The moved messages'
+        rows in the change feed are dropped with them, the move itself is not a change.
+        """
+        import json
+        import zlib
+        days = messages = 0
+        try:
+            cursor = self._database.cursor()
+            dates = [ row[0] for row in cursor.execute( "SELECT DISTINCT date FROM Message WHERE date < ? ORDER BY date", ( before, ) ) ]
+            for month, group in itertools.groupby( dates, lambda date: date[:7] ):
+                group = list( group )
+                archive = self._archive( month )
+                with archive:
+                    for date in group:
+                        rows = dict( ( row[0], list( row ) ) for row in
+                                     cursor.execute( "SELECT msgid, ts, text FROM Message WHERE date=?", ( date, ) ) )
+                        old = archive.execute( "SELECT data FROM ArchiveDay WHERE date=?", ( date, ) ).fetchone()
+                        if old:
+                            for row in json.loads( zlib.decompress( old[0] ) ):
+                                rows.setdefault( row[0], row )
+                        rows = sorted( rows.itervalues(), key=lambda row: ( row[1], row[0] ) )
+                        archive.execute( "INSERT OR REPLACE INTO ArchiveDay ( date, count, first, last, data ) VALUES ( ?, ?, ?, ?, ? )",
+                                         ( date, len(rows), rows[0][1], rows[-1][1], buffer( zlib.compress( json.dumps( rows ), 9 ) ) ) )
+                # the archive is committed first, so a failure here only leaves rows to archive again
+                with self._database.transaction() as conn:
+                    # Archived messages stay readable, so moving them is no change to the
+                    # feed: their Change rows go with them, and so do the deletes below
+                    conn.execute( "DELETE FROM Change WHERE tablename='Message'"
+                                  " AND id IN ( SELECT msgid FROM Message WHERE date >= ? AND date <= ? )", ( group[0], group[-1] ) )
+                    seq = conn.execute( "SELECT COALESCE( MAX(seq), 0 ) FROM Change" ).fetchone()[0]
+                    for date in group:
+                        conn.execute( "UPDATE MessageDaily SET archived=archived+1 WHERE date=?", ( date, ) )
+                        conn.execute( "DELETE FROM Message WHERE date=?", ( date, ) )
+                        messages += conn.execute( "SELECT changes()" ).fetchone()[0]
+                    conn.execute( "DELETE FROM Change WHERE seq > ? AND tablename='Message' AND op='delete'", ( seq, ) )
+                days += len( group )
+            return days, messages
+        except sqlite3.Error as e:
+            logging.error( "Failed to archive messages: before=%s error=%s", str(before), str(e.args[0]) )
+            return None
+
+
+#--------------------------------------------------------------------------
+class SearchTable(object):
+    """Full-text index over Task.name, Task.details and Message.text, kept current by triggers."""
+
+    def __init__( self, db ):
+        self._database = db
+        self._fts = False # False when this SQLite build lacks FTS5, searches then fall back to LIKE
+
+    def create( self ):
+        tables = [
+            ( 'TaskSearch',    "CREATE VIRTUAL TABLE TaskSearch USING fts5( name, details, content='Task', content_rowid='taskid' )" ),
+            ( 'MessageSearch', "CREATE VIRTUAL TABLE MessageSearch USING fts5( text, content='Message', content_rowid='msgid' )" )
+        ]
+        triggers = [
+            "CREATE TRIGGER IF NOT EXISTS TaskSearchInsert AFTER INSERT ON Task BEGIN"
+            "  INSERT INTO TaskSearch ( rowid, name, details ) VALUES ( NEW.taskid, NEW.name, NEW.details );"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS TaskSearchDelete AFTER DELETE ON Task BEGIN"
+            "  INSERT INTO TaskSearch ( TaskSearch, rowid, name, details ) VALUES ( 'delete', OLD.taskid, OLD.name, OLD.details );"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS TaskSearchUpdate AFTER UPDATE OF name, details ON Task BEGIN"
+            "  INSERT INTO TaskSearch ( TaskSearch, rowid, name, details ) VALUES ( 'delete', OLD.taskid, OLD.name, OLD.details );"
+            "  INSERT INTO TaskSearch ( rowid, name, details ) VALUES ( NEW.taskid, NEW.name, NEW.details );"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS MessageSearchInsert AFTER INSERT ON Message BEGIN"
+            "  INSERT INTO MessageSearch ( rowid, text ) VALUES ( NEW.msgid, NEW.text );"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS MessageSearchDelete AFTER DELETE ON Message BEGIN"
+            "  INSERT INTO MessageSearch ( MessageSearch, rowid, text ) VALUES ( 'delete', OLD.msgid, OLD.text );"
+            " END",
+            "CREATE TRIGGER IF NOT EXISTS MessageSearchUpdate AFTER UPDATE OF text ON Message BEGIN"
+            "  INSERT INTO MessageSearch ( MessageSearch, rowid, text ) VALUES ( 'delete', OLD.msgid, OLD.text );"
+            "  INSERT INTO MessageSearch ( rowid, text ) VALUES ( NEW.msgid, NEW.text );"
+            " END"
+        ]
+        try:
+            with self._database.transaction() as conn:
+                existing = set( row[0] for row in conn.execute( "SELECT name FROM sqlite_master WHERE type='table'" ) )
+                for name, statement in tables:
+                    if name not in existing:
+                        conn.execute( statement )
+                        # index rows written before the search table existed
+                        conn.execute( "INSERT INTO %s ( %s ) VALUES ( 'rebuild' )" % ( name, name ) )
+                for trigger in triggers:
+                    conn.execute( trigger )
+            self._fts = True
+        except sqlite3.Error as e:
+            logging.info( "Full-text search unavailable, using LIKE scans: %s", str( e.args[0] ) )
+
+    def search( self, query, kinds=( 'task', 'message' ), limit=20, offset=0, raw=False ):
+        """
+        Return up to limit matches for query, best first, as dicts with type, id, text and rank.
+        The query's whitespace separated terms must all match, as words with FTS5 and
+        as case-insensitive substrings otherwise. With raw the query is passed to
+        FTS5 MATCH as is, in its own syntax; without FTS5 it is then one substring.
+        """
+        terms = [ query ] if raw else query.split()
+        if not terms:
+            return []
+        params = { 'limit': limit, 'offset': offset }
+        if self._fts:
+            params['query'] = query if raw else " ".join( '"%s"' % term.replace( '"', '""' ) for term in terms )
+            arms = {
+                'task'    : "SELECT 'task', rowid, name, bm25(TaskSearch) FROM TaskSearch WHERE TaskSearch MATCH :query",
+                'message' : "SELECT 'message', rowid, text, bm25(MessageSearch) FROM MessageSearch WHERE MessageSearch MATCH :query"
+            }
+            order = "ORDER BY 4, 2"
+        else:
+            # like FTS5, every term has to match but each may be in either column
+            like = lambda columns: " AND ".join( "( %s )" % " OR ".join( "%s LIKE :term%u ESCAPE '\\'" % ( column, i ) for column in columns )
+                                                 for i in range( len( terms ) ) )
+            for i, term in enumerate( terms ):
+                params[ 'term%u' % i ] = '%%%s%%' % term.replace( '\\', '\\\\' ).replace( '%', '\\%' ).replace( '_', '\\_' )
+            arms = {
+                'task'    : "SELECT 'task', taskid, name, 0 FROM Task WHERE %s" % like( [ 'name', 'details' ] ),
+                'message' : "SELECT 'message', msgid, text, 0 FROM Message WHERE %s" % like( [ 'text' ] )
+            }
+            order = "ORDER BY 2 DESC"
+        statements = [ arms[kind] for kind in kinds if kind in arms ]
+        if not statements:
+            return []
+        try:
+            cursor = self._database.cursor()
+            cursor.execute( "%s %s LIMIT :limit OFFSET :offset" % ( " UNION ALL ".join( statements ), order ), params )
+            return [ dict( zip( [ 'type', 'id', 'text', 'rank' ], row ) ) for row in cursor ]
+        except sqlite3.Error as e:
+            logging.error( "Error searching: query=%s error=%s", query, str(e.args[0]) )
+            return None
+
+#--------------------------------------------------------------------------
+# Prepared statements kept per connection, the default of 100 is short of what
+# a daemon serving every command cycles through.
+CACHED_STATEMENTS = 256
+
+#--------------------------------------------------------------------------
+# Messages older than this many days are moved out by 'task archive'.
+ARCHIVE_KEEP_DAYS = 365
+
+# Monthly archive connections kept open, least recently used closed first, so
+# a daemon paging through years of history does not hold a file per month.
+ARCHIVE_CONNECTIONS = 4
+
+#--------------------------------------------------------------------------
+# transaction() retries a BEGIN IMMEDIATE or COMMIT that finds the database
+# locked by another process, on top of busy_timeout. It sleeps LOCK_RETRY_MIN
+# seconds, doubling up to LOCK_RETRY_MAX, jittered so waiting processes do not
+# retry in step, and gives up after LOCK_TIMEOUT seconds in all. A BEGIN that
+# takes longer than LOCK_CONTENDED counts as contended in Database.contention.
+LOCK_TIMEOUT = 30.0
+LOCK_RETRY_MIN = 0.002
+LOCK_RETRY_MAX = 0.1
+LOCK_CONTENDED = 0.002
+
+CONTENTION_COUNTERS = ( 'transactions', 'contended', 'retries', 'failed', 'waited', 'max_wait' )
+
+#--------------------------------------------------------------------------
+# Database.snapshot copies this many pages per step of the backup API, then
+# sleeps so writers get the database between steps; 1024 pages is 4 MiB.
+BACKUP_PAGES = 1024
+BACKUP_SLEEP = 0.005
+
+#--------------------------------------------------------------------------
+# Connection profiles: PRAGMAs applied, in order, every time a Database connects.
+# WAL lets the CLI and GUI read while the other one writes.
+PROFILES = {
+    'default' : [],
+    'tuned'   : [
+        ( 'busy_timeout', 5000 ),           # ms to wait on a locked database
+        ( 'journal_mode', 'WAL' ),
+        ( 'synchronous',  'NORMAL' ),       # safe with WAL, skips the fsync per commit
+        ( 'cache_size',   -16384 ),         # negative means KiB, so 16 MiB
+        ( 'mmap_size',    256*1024*1024 ),
+        ( 'temp_store',   'MEMORY' )
+    ]
+}
+
+# Schema migrations; MIGRATIONS[n] upgrades a database from user_version n to n+1.
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS TaskParent ON Task ( parent )",
+        "CREATE INDEX IF NOT EXISTS TaskStatus ON Task ( statusid )",
+        "CREATE INDEX IF NOT EXISTS MessageDate ON Message ( date )"
+    ],
+    [
+        # ( date, ts ) covers date lookups too, and ends in msgid for keyset paging
+        "CREATE INDEX IF NOT EXISTS MessageDateTs ON Message ( date, ts )",
+        "DROP INDEX IF EXISTS MessageDate"
+    ],
+    [
+        # insert used to ignore its status, those tasks were all meant to be open
+        "UPDATE Task SET statusid=( SELECT statusid FROM Status WHERE short='O' ) WHERE statusid IS NULL",
+        "CREATE INDEX IF NOT EXISTS TaskParentStatus ON Task ( parent, statusid )",
+        "DROP INDEX IF EXISTS TaskParent"
+    ],
+    [
+        # change feed, see ChangeTable
+        "CREATE TABLE IF NOT EXISTS Change ( seq INTEGER PRIMARY KEY AUTOINCREMENT, tablename TEXT, op TEXT,"
+        " id INTEGER, parent INTEGER, oldparent INTEGER, ts TIMESTAMP DEFAULT ( strftime( '%Y-%m-%d %H:%M:%f', 'now' ) ) )",
+        "CREATE TABLE IF NOT EXISTS ChangeHorizon ( seq INTEGER )",
+        "INSERT INTO ChangeHorizon ( seq ) SELECT 0 WHERE NOT EXISTS ( SELECT 1 FROM ChangeHorizon )",
+        "CREATE TRIGGER IF NOT EXISTS ChangeTaskInsert AFTER INSERT ON Task BEGIN"
+        "  INSERT INTO Change ( tablename, op, id, parent ) VALUES ( 'Task', 'insert', NEW.taskid, NEW.parent );"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS ChangeTaskUpdate AFTER UPDATE OF name, details, statusid ON Task BEGIN"
+        "  INSERT INTO Change ( tablename, op, id, parent ) VALUES ( 'Task', 'update', NEW.taskid, NEW.parent );"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS ChangeTaskMove AFTER UPDATE OF parent ON Task WHEN NEW.parent IS NOT OLD.parent BEGIN"
+        "  INSERT INTO Change ( tablename, op, id, parent, oldparent ) VALUES ( 'Task', 'move', NEW.taskid, NEW.parent, OLD.parent );"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS ChangeTaskDelete AFTER DELETE ON Task BEGIN"
+        "  INSERT INTO Change ( tablename, op, id, parent ) VALUES ( 'Task', 'delete', OLD.taskid, OLD.parent );"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS ChangeMessageInsert AFTER INSERT ON Message BEGIN"
+        "  INSERT INTO Change ( tablename, op, id ) VALUES ( 'Message', 'insert', NEW.msgid );"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS ChangeMessageUpdate AFTER UPDATE ON Message BEGIN"
+        "  INSERT INTO Change ( tablename, op, id ) VALUES ( 'Message', 'update', NEW.msgid );"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS ChangeMessageDelete AFTER DELETE ON Message BEGIN"
+        "  INSERT INTO Change ( tablename, op, id ) VALUES ( 'Message', 'delete', OLD.msgid );"
+        " END"
+    ],
+    [
+        # per day message rollup, archived days keep their row, see MessageTable
+        "CREATE TABLE IF NOT EXISTS MessageDaily ( date DATE PRIMARY KEY, count INTEGER, first TIMESTAMP, last TIMESTAMP,"
+        " minid INTEGER, maxid INTEGER, archived INTEGER DEFAULT 0 )",
+        "INSERT OR REPLACE INTO MessageDaily ( date, count, first, last, minid, maxid )"
+        " SELECT date, COUNT(*), MIN(ts), MAX(ts), MIN(msgid), MAX(msgid) FROM Message GROUP BY date",
+        "CREATE TRIGGER IF NOT EXISTS MessageDailyInsert AFTER INSERT ON Message BEGIN"
+        "  INSERT INTO MessageDaily ( date, count, first, last, minid, maxid ) VALUES ( NEW.date, 1, NEW.ts, NEW.ts, NEW.msgid, NEW.msgid )"
+        "   ON CONFLICT ( date ) DO UPDATE SET count=count+1, first=MIN( first, excluded.first ), last=MAX( last, excluded.last ),"
+        "   minid=MIN( minid, excluded.minid ), maxid=MAX( maxid, excluded.maxid );"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS MessageDailyDelete AFTER DELETE ON Message"
+        " WHEN NOT ( SELECT archived FROM MessageDaily WHERE date=OLD.date ) BEGIN"
+        "  UPDATE MessageDaily SET count=count-1 WHERE date=OLD.date;"
+        "  DELETE FROM MessageDaily WHERE date=OLD.date AND count=0;"
+        " END"
+    ],
+    [
+        # sibling order, see TaskTable.set_parent; new tasks go last
+        "ALTER TABLE Task ADD COLUMN position REAL",
+        "UPDATE Task SET position=taskid",
+        "CREATE INDEX IF NOT EXISTS TaskParentPosition ON Task ( parent, position )",
+        "CREATE TRIGGER IF NOT EXISTS TaskPositionInsert AFTER INSERT ON Task WHEN NEW.position IS NULL BEGIN"
+        "  UPDATE Task SET position=( SELECT COALESCE( MAX(position), 0 ) + 1 FROM Task WHERE parent IS NEW.parent )"
+        "   WHERE taskid=NEW.taskid;"
+        " END",
+        # reordering is a change too; filling in a new task's position is not, and a
+        # move to another parent is already recorded by ChangeTaskMove
+        "DROP TRIGGER IF EXISTS ChangeTaskUpdate",
+        "CREATE TRIGGER ChangeTaskUpdate AFTER UPDATE OF name, details, statusid, position ON Task"
+        " WHEN OLD.position IS NOT NULL AND NEW.parent IS OLD.parent BEGIN"
+        "  INSERT INTO Change ( tablename, op, id, parent ) VALUES ( 'Task', 'update', NEW.taskid, NEW.parent );"
+        " END"
+    ],
+    [
+        # one row per Database.snapshot
+        "CREATE TABLE IF NOT EXISTS Backup ( backupid INTEGER PRIMARY KEY, ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP,"
+        " filename TEXT, method TEXT, bytes INTEGER, seconds REAL, integrity TEXT )"
+    ],
+    [
+        # saved GUI views, see Database.view_state
+        "CREATE TABLE IF NOT EXISTS ViewState ( name TEXT PRIMARY KEY, data BLOB )"
+    ]
+]
 
 #--------------------------------------------------------------------------
 class Database(object):
-    def __init__( self, filename=os.path.join( GetConfigDir(), 'tasks.db' ) ):
+    # hierarchy adds the Task.path index, see TaskTable.create_hierarchy. It is off
+    # by default: a path grows with depth, so its storage grows with the square of
+    # it. A database that has the index keeps using it until 'task hierarchy off'.
+    def __init__( self, filename=None, hierarchy=False, profile='tuned', profiler=None ):
+        if filename is None:
+            filename = os.path.join( GetConfigDir(), 'tasks.db' )
         self._filename = filename
-        self._connection = sqlite3.connect( self._filename )
+        self._hierarchy = hierarchy
+        self._profiler = profiler
+        # autocommit, transaction() issues BEGIN/COMMIT itself so DDL and nesting behave
+        self._connection = sqlite3.connect( self._filename, isolation_level=None, cached_statements=CACHED_STATEMENTS )
+        if profiler:
+            self._connection = profiler.connection( self._connection )
+        self._depth = 0       # nesting level of transaction()
+        self._failed = False  # set when a nested block fails, the outer block then rolls back
+        self._contention = dict.fromkeys( CONTENTION_COUNTERS, 0 )
+        self.configure( PROFILES[profile] if isinstance( profile, basestring ) else profile )
 
         self._tasks = TaskTable( self )
         self._messages = MessageTable( self )
+        self._search = SearchTable( self )
+        self._changes = ChangeTable( self )
+        if profiler:
+            for obj in ( self, self._tasks, self._messages, self._search, self._changes ):
+                profiler.instrument( obj )
 
         self.init()
 
@@ -177,96 +1333,815 @@ class Database(object):
         out.write( "DB filename=%s\n\n" % self._filename )
         self._tasks.debug( out )
         self._messages.debug( out )
+        self._changes.debug( out )
+        if self._profiler:
+            self._profiler.report( out )
+
+    def configure( self, pragmas ):
+        for name, value in pragmas:
+            try:
+                self._connection.execute( "PRAGMA %s=%s" % ( name, value ) ).fetchall()
+            except sqlite3.Error as e:
+                logging.error( "Failed to set PRAGMA %s=%s: %s", name, value, str( e.args[0] ) )
+
+    def _schema( self ):
+        # ( user_version, has hierarchy triggers, has search triggers ) in one read
+        try:
+            return self._connection.execute(
+                "SELECT user_version,"
+                " EXISTS ( SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='TaskPathMove' ),"
+                " EXISTS ( SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='MessageSearchUpdate' )"
+                " FROM pragma_user_version" ).fetchone()
+        except sqlite3.Error as e:
+            logging.error( "Failed to read schema version: %s", str( e.args[0] ) )
+            return ( 0, False, False )
 
     def init( self ):
+        version, hierarchy, search = self._schema()
+        if version == len( MIGRATIONS ) and search and ( hierarchy or not self._hierarchy ):
+            # schema is current, skip the DDL
+            self._tasks._hierarchy = bool( hierarchy )
+            self._search._fts = True
+            return
+
         self._tasks.create()
         self._messages.create()
+        self.migrate()
+        if self._hierarchy:
+            self._tasks.create_hierarchy()
+        self._search.create()
+
+    def migrate( self ):
+        try:
+            version = self._connection.execute( "PRAGMA user_version" ).fetchone()[0]
+            for statements in MIGRATIONS[version:]:
+                with self.transaction() as conn:
+                    for statement in statements:
+                        conn.execute( statement )
+                    version += 1
+                    conn.execute( "PRAGMA user_version=%u" % version )
+        except sqlite3.Error as e:
+            logging.error( "Failed to migrate database: %s", str( e.args[0] ) )
 
     def connection( self ):
         return self._connection
 
+    def _locked( self, conn, statement ):
+        # run statement, retrying with backoff while another connection holds the lock
+        start = time.time()
+        delay = LOCK_RETRY_MIN
+        while True:
+            try:
+                conn.execute( statement )
+                return time.time() - start
+            except sqlite3.OperationalError as e:
+                waited = time.time() - start
+                if 'locked' not in str( e.args[0] ):
+                    raise
+                if waited + delay > LOCK_TIMEOUT:
+                    self._contention['failed'] += 1
+                    logging.error( "Database locked, gave up on %s after %.1f s", statement, waited )
+                    raise
+                self._contention['retries'] += 1
+                time.sleep( delay * random.uniform( 0.5, 1.5 ) )
+                delay = min( delay * 2, LOCK_RETRY_MAX )
+
+    def contention( self, reset=False ):
+        """
+        Return counts of how often this connection waited to write: transactions
+        begun, contended (waited over LOCK_CONTENDED), retries, failed (gave up),
+        plus the total and longest wait in seconds.
+        """
+        counts = dict( self._contention )
+        if reset:
+            self._contention = dict.fromkeys( CONTENTION_COUNTERS, 0 )
+        return counts
+
+    @contextlib.contextmanager
+    def transaction( self ):
+        """
+        Run the block inside BEGIN IMMEDIATE ... COMMIT, or join the enclosing
+        transaction when nested. An exception anywhere rolls back the whole
+        outermost transaction, even if an inner caller caught and logged it.
+        While another process writes, BEGIN and COMMIT wait for it with backoff,
+        up to LOCK_TIMEOUT seconds, before raising.
+        """
+        conn = self._connection
+        if self._depth:
+            self._depth += 1
+            try:
+                yield conn
+            except:
+                self._failed = True
+                raise
+            finally:
+                self._depth -= 1
+            return
+
+        waited = self._locked( conn, "BEGIN IMMEDIATE" )
+        counts = self._contention
+        counts['transactions'] += 1
+        if waited > LOCK_CONTENDED:
+            counts['contended'] += 1
+            counts['waited'] += waited
+            counts['max_wait'] = max( counts['max_wait'], waited )
+        self._depth, self._failed = 1, False
+        try:
+            yield conn
+        except:
+            self._depth = 0
+            conn.execute( "ROLLBACK" )
+            raise
+        self._depth = 0
+        if self._failed:
+            conn.execute( "ROLLBACK" )
+            raise sqlite3.OperationalError( "transaction rolled back after an earlier error" )
+        try:
+            # only a rollback journal makes COMMIT wait, for readers to finish
+            self._locked( conn, "COMMIT" )
+        except sqlite3.Error:
+            conn.execute( "ROLLBACK" )
+            raise
+
     def cursor( self ):
         return self._connection.cursor()
 
+    def data_version( self ):
+        # Changes whenever another connection commits; our own writes leave it alone.
+        try:
+            return self._connection.execute( "PRAGMA data_version" ).fetchone()[0]
+        except sqlite3.Error as e:
+            logging.error( "Failed to read data version: %s", str( e.args[0] ) )
+            return None
+
+    def snapshot( self, filename, vacuum=False, check=True, pages=BACKUP_PAGES ):
+        """
+        Copy the database to filename while it stays in use, returning a dict
+        describing the copy, or None on error.
+
+        The copy is read on a connection of its own. With the backup API it goes
+        pages at a time, writers getting the database between steps; a write from
+        another connection restarts the copy. vacuum, or a Python without the
+        backup API, makes it one VACUUM INTO instead: a single read transaction
+        that also compacts the copy, and under WAL never holds writers up. check
+        runs PRAGMA integrity_check on the copy. The copy is written beside
+        filename and renamed into place only when complete, and every snapshot
+        is recorded in the Backup table.
+        """
+        partial = filename + '.part'
+        start = time.time()
+        source = None
+        try:
+            if os.path.exists( partial ):
+                os.remove( partial )
+            source = sqlite3.connect( self._filename, isolation_level=None )
+            if not vacuum and hasattr( source, 'backup' ):
+                method = 'backup'
+                target = sqlite3.connect( partial )
+                try:
+                    source.backup( target, pages=pages, sleep=BACKUP_SLEEP )
+                finally:
+                    target.close()
+            else:
+                method = 'vacuum'
+                source.execute( "VACUUM INTO ?", (partial,) )
+            # the WAL grew while the copy held back checkpoints; catch up here rather
+            # than in the next writer's commit
+            source.execute( "PRAGMA wal_checkpoint(PASSIVE)" ).fetchall()
+
+            integrity = None
+            if check:
+                target = sqlite3.connect( partial )
+                try:
+                    integrity = '; '.join( row[0] for row in target.execute( "PRAGMA integrity_check" ) )
+                finally:
+                    target.close()
+            if os.path.exists( filename ):
+                os.remove( filename )
+            os.rename( partial, filename )
+
+            result = { 'filename': os.path.abspath( filename ), 'method': method, 'bytes': os.path.getsize( filename ),
+                       'seconds': time.time() - start, 'integrity': integrity }
+            with self.transaction() as conn:
+                conn.execute( "INSERT INTO Backup ( filename, method, bytes, seconds, integrity ) VALUES (?,?,?,?,?)",
+                              ( result['filename'], method, result['bytes'], result['seconds'], integrity ) )
+            return result
+        except ( sqlite3.Error, OSError ) as e:
+            logging.error( "Failed to snapshot database to %s: %s", filename, str( e ) )
+            return None
+        finally:
+            if source:
+                source.close()
+
+    def backups( self, limit=20 ):
+        """Return the most recent snapshots as ( ts, filename, method, bytes, seconds, integrity ) rows."""
+        try:
+            return self._connection.execute( "SELECT ts, filename, method, bytes, seconds, integrity FROM Backup"
+                                             " ORDER BY backupid DESC LIMIT ?", (limit,) ).fetchall()
+        except sqlite3.Error as e:
+            logging.error( "Failed to read backups: %s", str( e.args[0] ) )
+            return None
+
+    def view_state( self, name ):
+        """Return the state save_view_state stored under name, None when there is none or on error."""
+        import json
+        import zlib
+        try:
+            row = self._connection.execute( "SELECT data FROM ViewState WHERE name=?", (name,) ).fetchone()
+            return json.loads( zlib.decompress( row[0] ) ) if row else None
+        except ( sqlite3.Error, zlib.error, ValueError ) as e:
+            logging.error( "Failed to read view %s: %s", name, str( e.args[0] ) )
+            return None
+
+    def save_view_state( self, name, state ):
+        """Store state, anything JSON can hold, under name as one compressed row."""
+        import json
+        import zlib
+        try:
+            data = zlib.compress( json.dumps( state, separators=( ',', ':' ) ), 9 )
+            with self.transaction() as conn:
+                conn.execute( "INSERT OR REPLACE INTO ViewState ( name, data ) VALUES ( ?, ? )", ( name, buffer( data ) ) )
+            return True
+        except sqlite3.Error as e:
+            logging.error( "Failed to save view %s: %s", name, str( e.args[0] ) )
+            return False
+
+    def records( self ):
+        """Yield every task and then every message as an export record."""
+        for taskid, parent, statusid, name, details in self._tasks.iterate():
+            yield { 'type': 'task', 'id': taskid, 'parent': parent, 'status': statusid, 'name': name, 'details': details }
+        for msgid, date, ts, text in self._messages.iterate():
+            yield { 'type': 'message', 'id': msgid, 'date': date, 'ts': ts, 'text': text }
+
+    def load( self, records, batch=10000 ):
+        """
+        Bulk load task and message records in a single transaction.
+
+        Tasks get fresh ids and their parents are remapped to match; a parent that is
+        not part of the input leaves the task at the top level. A task's status may
+        be a statusid, a status name or short code, and defaults to Open; an unknown
+        status fails the whole load. Returns a
+        ( tasks, messages ) count tuple, or None if nothing was loaded.
+        """
+        # The staging table, its index and the statement journal of the final
+        # INSERT all live in temp storage, which the tuned profile keeps in memory;
+        # spill them to disk for the load. temp_store can only change outside a
+        # transaction, so a load nested in a batch keeps the current setting.
+        store = None if self._depth else self._temp_store( 'FILE' )
+        try:
+            with self.transaction() as conn:
+                conn.execute( "DROP TABLE IF EXISTS temp.ImportTask" )
+                conn.execute( "CREATE TEMP TABLE ImportTask ( seq INTEGER PRIMARY KEY, oldid INTEGER, parent INTEGER,"
+                              " statusid INTEGER, name TEXT, details TEXT )" )
+                tasks, messages = [], []
+                counts = [ 0, 0 ]
+                # status may be a statusid, as export writes it, or a name or short code
+                known = set( row[0] for row in self._tasks.statuses() )
+                def statusid( status ):
+                    if status is None or status == '':
+                        status = 'O'
+                    elif isinstance( status, basestring ) and status.isdigit():
+                        status = int( status )
+                    return status if status in known else self._tasks._statusid( status )
+                def flush():
+                    conn.executemany( "INSERT INTO ImportTask ( oldid, parent, statusid, name, details ) VALUES (?,?,?,?,?)", tasks )
+                    conn.executemany( "INSERT INTO Message ( date, ts, text ) VALUES (?,?,?)", messages )
+                    counts[0] += len(tasks)
+                    counts[1] += len(messages)
+                    del tasks[:]
+                    del messages[:]
+
+                for record in records:
+                    if record.get( 'type', 'task' ) == 'message':
+                        messages.append( ( record.get('date'), record.get('ts'), record.get('text') ) )
+                    else:
+                        tasks.append( ( record.get('id'), record.get('parent'), statusid( record.get('status') ),
+                                        record.get('name'), record.get('details') or "" ) )
+                    if len(tasks) + len(messages) >= batch:
+                        flush()
+                flush()
+
+                # New ids are base + staging sequence, above anything AUTOINCREMENT has handed out
+                base = conn.execute( "SELECT MAX( COALESCE( (SELECT MAX(taskid) FROM Task), 0 ),"
+                                     " COALESCE( (SELECT seq FROM sqlite_sequence WHERE name='Task'), 0 ) )" ).fetchone()[0]
+                conn.execute( "CREATE INDEX temp.ImportTaskOld ON ImportTask ( oldid )" )
+                conn.execute( "INSERT INTO Task ( taskid, name, details, parent, statusid )"
+                              " SELECT ?+seq, name, details,"
+                              "  (SELECT ?+MIN(p.seq) FROM ImportTask p WHERE p.oldid=ImportTask.parent), statusid"
+                              " FROM ImportTask ORDER BY seq", ( base, base ) )
+                if self._tasks.hierarchy:
+                    # parents may have been inserted after their kids
+                    self._tasks._rebuild_hierarchy( conn )
+                conn.execute( "DROP TABLE temp.ImportTask" )
+            return tuple( counts )
+        except sqlite3.Error as e:
+            logging.error( "Failed to load records: %s", str( e.args[0] ) )
+            return None
+        finally:
+            if store is not None:
+                self._temp_store( store )
+
+    def _temp_store( self, value ):
+        # Switch PRAGMA temp_store, returning the previous value. The switch drops
+        # every temp table, so the archived days unpacked so far are gone too.
+        try:
+            previous = self._connection.execute( "PRAGMA temp_store" ).fetchone()[0]
+            self._connection.execute( "PRAGMA temp_store=%s" % value )
+            self._messages._unpacked.clear()
+            return previous
+        except sqlite3.Error as e:
+            logging.error( "Failed to set PRAGMA temp_store=%s: %s", value, str( e.args[0] ) )
+            return None
+
     @property
     def tasks( self ):
         return self._tasks
 
+    @property
+    def messages( self ):
+        return self._messages
+
+    @property
+    def search( self ):
+        return self._search
+
+    @property
+    def changes( self ):
+        return self._changes
+
+    @property
+    def profiler( self ):
+        return self._profiler
+
+    @property
+    def filename( self ):
+        return self._filename
+
 #--------------------------------------------------------------------------
 class Taskbook(object):
     def __init__( self, database ):
         self._database = database
-        self._tasks = dict() # { taskid: task }
+        self._tasks = None   # { taskid: TaskRecord }, None until first loaded
+        self._version = None # database data_version the cache was loaded at
+        self._seq = None     # change feed position the cache is current to
+        self._root = self._make_root()
+        self._pending = None # cache changes waiting for the current batch to commit
+        self._counts = {}    # { subtree taskid: { short status: count } }
+        self._counts_version = None
+        if database.profiler:
+            database.profiler.instrument( self )
 
     def debug( self, out ):
-        out.write( "In memory tasks:\n" )
+        out.write( "In memory tasks (version=%s):\n" % str(self._version) )
         out.write( "\t%s\n\n" % str(self._tasks) )
         self._database.debug( out )
 
+    def _make_root( self ):
+        # Hidden parent of all top level tasks, kids kept in sibling order like every other node.
+        return TaskRecord( None, 'Hidden root', '', None, None )
+
+    def _node( self, taskid ):
+        if taskid is None:
+            return self._root
+        return self._tasks.get( taskid )
+
     def refresh( self ):
+        self._version = self._database.data_version()
+        self._seq = self._database.changes.last()
         self._tasks = dict()
+        self._root = self._make_root()
+
+        # Records arrive ordered by taskid, which is sibling order too unless tasks were
+        # reordered; only the kids of those parents get sorted afterwards.
+        # Kids seen before their parent wait in orphans until it turns up.
+        orphans = {}
+        unsorted = set()
+        tasks = self._tasks
+        try:
+            for task in self._database.tasks.records():
+                tasks[ task.taskid ] = task
+                if task.taskid in orphans:
+                    task.kids = orphans.pop( task.taskid )
+                parent = self._node( task.parent )
+                kids = parent.kids if parent else orphans.setdefault( task.parent, array.array( 'l' ) )
+                if kids and tasks[ kids[-1] ].position > task.position:
+                    unsorted.add( task.parent )
+                kids.append( task.taskid )
+        except sqlite3.Error as e:
+            logging.error( "Error loading tasks: %s", str( e.args[0] ) )
+        for taskid in unsorted:
+            parent = self._node( taskid )
+            if parent:
+                parent.kids = array.array( 'l', sorted( parent.kids, key=lambda kid: ( tasks[kid].position, kid ) ) )
+
+    def sync( self ):
+        """Catch the cache up when another connection has changed the database."""
+        version = self._database.data_version()
+        if self._tasks is not None and version is not None and version == self._version:
+            return
+        changes = None
+        if self._tasks is not None and self._seq is not None:
+            changes = self._database.changes.since( self._seq, limit=max( 1000, len(self._tasks) // 10 ) + 1, tablename='Task' )
+        if changes is None or len(changes) > max( 1000, len(self._tasks) // 10 ):
+            # too far behind, a reload is cheaper
+            self.refresh()
+            return
+        self._version = version
+        if changes:
+            self._seq = changes[-1]['seq']
+            self._counts.clear()
+            self._apply( set( change['id'] for change in changes ) )
+
+    def _apply( self, ids ):
+        # Bring the cached copies of ids in line with the database
+        records = self._database.tasks.fetch( ids )
+        if records is None:
+            self.refresh()
+            return
+        current = dict( ( task.taskid, task ) for task in records )
+        for taskid in ids:
+            task = self._tasks.get( taskid )
+            if task:
+                self._detach( task )
+                if taskid in current:
+                    fresh = current[ taskid ]
+                    task.name, task.details, task.parent, task.statusid, task.position = \
+                        fresh.name, fresh.details, fresh.parent, fresh.statusid, fresh.position
+                    current[ taskid ] = task
+                else:
+                    del self._tasks[ taskid ]
+            elif taskid in current:
+                self._tasks[ taskid ] = current[ taskid ]
+        for taskid in sorted( current ):
+            self._attach( self._tasks[ taskid ] )
+
+    def _attach( self, task ):
+        parent = self._node( task.parent )
+        if parent:
+            # binary search on ( position, taskid ), the kids array only holds ids
+            kids, tasks, key = parent.kids, self._tasks, ( task.position, task.taskid )
+            lo, hi = 0, len(kids)
+            while lo < hi:
+                mid = ( lo + hi ) // 2
+                kid = tasks[ kids[mid] ]
+                if ( kid.position, kid.taskid ) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            kids.insert( lo, task.taskid )
+
+    def _detach( self, task ):
+        parent = self._node( task.parent )
+        if parent and task.taskid in parent.kids:
+            parent.kids.remove( task.taskid )
+
+    def _changed( self, change, *args ):
+        # Patch the cache, or queue the patch until the running batch commits
+        if self._pending is not None:
+            self._pending.append( ( change, args ) )
+        elif self._tasks is not None:
+            change( *args )
+
+    @contextlib.contextmanager
+    def batch( self ):
+        """
+        Group operations into one transaction and one cache update:
+
+            with book.batch():
+                book.move( 3, 1 )
+                book.delete( 7 )
+
+        If any operation fails everything is rolled back and sqlite3.Error raised.
+        """
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = []
+        try:
+            with self._database.transaction():
+                yield self
+            pending = self._pending
+        except:
+            self._counts.clear() # counted inside the batch, before its rollback
+            raise
+        finally:
+            self._pending = None
+        if self._tasks is not None:
+            for change, args in pending:
+                change( *args )
+
+    def _cache_add( self, task ):
+        self._tasks[ task.taskid ] = task
+        self._attach( task )
+
+    def _cache_delete( self, taskid ):
+        if taskid in self._tasks:
+            ids = [ taskid ]
+            ids.extend( self._kids( taskid ) )
+            self._detach( self._tasks[taskid] )
+            for id in ids:
+                del self._tasks[id]
 
-        raw = self._database.tasks.select()
-        for task in raw:
-            task['kids'] = []
-            self._tasks[ task['taskid'] ] = task
+    def _cache_set( self, taskid, field, value ):
+        if taskid in self._tasks:
+            setattr( self._tasks[taskid], field, value )
 
-        for task in raw:
-            if task['parent']:
-                self._tasks[ task['parent'] ]['kids'].append( task['taskid'] )
+    def _cache_move( self, taskid, parent, position ):
+        if taskid in self._tasks:
+            task = self._tasks[taskid]
+            self._detach( task )
+            task.parent = parent
+            task.position = position
+            self._attach( task )
 
-    def add( self, name, details="" ):
-        return self._database.tasks.insert( name=name, details=details )
+    def _cache_rebalance( self, parent ):
+        node = self._node( parent )
+        if node:
+            self._apply( list( node.kids ) )
 
-    def _list( self, task, indent=0 ):
-        print "%4i : %s%s" % ( task['taskid'], '  '*indent, task['name'])
-        for kid in task['kids']:
-            self._list( self._tasks[ kid ], indent+1 )
+    def add( self, name, details="", status='O' ):
+        taskid = self._database.tasks.insert( name=name, details=details, status=status )
+        if taskid:
+            self._uncount( [ taskid ] )
+            # read back for the position TaskPositionInsert gave it
+            self._changed( self._cache_add, self._database.tasks.fetch( [ taskid ] )[0] )
+        return taskid
 
-    def list( self ):
-        self.refresh()
-        for task in self.select():
-            self._list( task )
+    def counts( self, subtree=None ):
+        """
+        Return { short status: count } for the tasks below subtree, or the whole
+        book when None. Cached per subtree until a write below it.
+        """
+        version = self._database.data_version()
+        if version != self._counts_version:
+            self._counts.clear()
+            self._counts_version = version
+        counts = self._counts.get( subtree )
+        if counts is None:
+            byid = self._database.tasks.counts( subtree )
+            if byid is None:
+                return None
+            counts = dict( ( short, byid.get( statusid, 0 ) ) for statusid, name, short in self._database.tasks.statuses() )
+            self._counts[ subtree ] = counts
+        return counts
+
+    def _uncount( self, taskids ):
+        # Drop the cached counts a write to taskids changes: the whole book's and
+        # those of their ancestors, the subtrees they are in
+        if not self._counts:
+            return
+        self._counts.pop( None, None )
+        for taskid in taskids:
+            for ancestor in self._database.tasks.ancestors( taskid ) or []:
+                self._counts.pop( ancestor, None )
+
+    def _walk( self, depth=None ):
+        # Cached tree as ( taskid, name, level ) depth first. An explicit stack of
+        # kid iterators rather than recursion, deep books would hit the recursion limit.
+        stack = [ iter( self._root.kids ) ]
+        while stack:
+            for kid in stack[-1]:
+                task = self._tasks[ kid ]
+                yield task.taskid, task.name, len(stack) - 1
+                if task.kids and ( depth is None or len(stack) < depth ):
+                    stack.append( iter( task.kids ) )
+                break
+            else:
+                stack.pop()
+
+    def _render( self, rows, out ):
+        # one write per block of tasks rather than a print per task
+        lines = []
+        for taskid, name, level in rows:
+            lines.append( "%4i : %s%s\n" % ( taskid, '  '*level, name ) )
+            if len(lines) == 4096:
+                out.write( ''.join( lines ) )
+                lines = []
+        out.write( ''.join( lines ) )
+
+    def list( self, status=None, root=None, depth=None, limit=None ):
+        """
+        Print the book, or root and its subtree, at most depth levels and limit
+        tasks. Filtered, rooted and limited listings are read straight from the
+        database, so only the printed rows are loaded. Returns False for an
+        unknown root.
+        """
+        if root is not None:
+            tasks = self._database.tasks.fetch( [ root ] )
+            if not tasks:
+                return False
+            rows = self._database.tasks.walk( root=root, status=status,
+                                              depth=None if depth is None else depth - 1,
+                                              limit=None if limit is None else limit - 1 )
+            rows = itertools.chain( [ ( root, tasks[0].name, -1 ) ], rows )
+            rows = ( ( taskid, name, level + 1 ) for taskid, name, level in rows )
+        elif status or depth is not None or limit is not None:
+            rows = self._database.tasks.walk( status=status, depth=depth, limit=limit )
+        else:
+            self.sync()
+            rows = self._walk( depth )
+        if limit is not None:
+            rows = itertools.islice( rows, max( limit, 0 ) )
+        self._render( rows, sys.stdout )
+        return True
+
+    def show( self, ids ):
+        """Print just the tasks ids, as list would, read without loading the book."""
+        tasks = dict( ( task.taskid, task ) for task in self._database.tasks.fetch( ids ) or [] )
+        self._render( ( ( taskid, tasks[taskid].name, 0 ) for taskid in ids if taskid in tasks ), sys.stdout )
 
     def _kids( self, taskid ):
-        kids = self._tasks[taskid]['kids']
-        for kid in kids:
-            kids.extend( self._kids( kid ) )
+        kids = []
+        pending = list( self._tasks[taskid].kids )
+        while pending:
+            kid = pending.pop()
+            kids.append( kid )
+            pending.extend( self._tasks[kid].kids )
         return kids
 
     def delete( self, taskid ):
-        self.refresh()
-        ids = [ taskid ]
-        ids.extend( self._kids( taskid ) )
-        return self._database.tasks.delete( ids )
+        """Delete a task and its subtree, returning the number of tasks removed or None on error."""
+        # while its ancestors and subtree can still be found
+        self._uncount( [ taskid ] )
+        if self._counts:
+            for kid in self._database.tasks.descendants( taskid ) or []:
+                self._counts.pop( kid, None )
+        count = self._database.tasks.delete_subtree( taskid )
+        if count:
+            self._changed( self._cache_delete, taskid )
+        return count
 
     def update( self, taskid, name ):
-        return self._database.tasks.update( taskid, name )
+        if not self._database.tasks.update( taskid, name ):
+            return False
+        self._changed( self._cache_set, taskid, 'name', name )
+        return True
+
+    def set_status( self, taskid, status ):
+        statusid = self._database.tasks.set_status( taskid, status )
+        if not statusid:
+            return False
+        self._uncount( [ taskid ] )
+        self._changed( self._cache_set, taskid, 'statusid', statusid )
+        return True
+
+    def move( self, taskid, parent, before=None ):
+        """Move taskid below parent (None for top level), ahead of the sibling before or last."""
+        parent = parent or None
+        rebalances = self._database.tasks.rebalances
+        self._uncount( [ taskid ] ) # the subtrees it leaves
+        position = self._database.tasks.set_parent( taskid, parent, before )
+        if position is None:
+            return False
+        self._uncount( [ taskid ] ) # and those it joins
+        self._changed( self._cache_move, taskid, parent, position )
+        if self._database.tasks.rebalances != rebalances:
+            self._changed( self._cache_rebalance, parent )
+        return True
+
+    def load( self, records ):
+        counts = self._database.load( records )
+        if counts:
+            self._tasks = None # reloaded on next use
+            self._counts.clear()
+        return counts
+
+    def changes_since( self, seq, limit=None, tablename=None ):
+        return self._database.changes.since( seq, limit=limit, tablename=tablename )
+
+    def last_change( self ):
+        return self._database.changes.last()
 
-    def move( self, taskid, parent ):
-        self.refresh()
-        return self._database.tasks.set_parent( taskid, parent )
+    def data_version( self ):
+        return self._database.data_version()
+
+    def view_state( self, name ):
+        return self._database.view_state( name )
+
+    def save_view_state( self, name, state ):
+        return self._database.save_view_state( name, state )
+
+    def children( self, parentid=None ):
+        """Load one level of the tree straight from the database, bypassing the cache."""
+        return self._database.tasks.children( parentid )
+
+    def search( self, query, kinds=( 'task', 'message' ), limit=20, offset=0, raw=False ):
+        return self._database.search.search( query, kinds=kinds, limit=limit, offset=offset, raw=raw )
+
+    def descendants( self, taskid ):
+        return self._database.tasks.descendants( taskid )
+
+    def depth( self, taskid ):
+        return self._database.tasks.depth( taskid )
+
+    def path( self, taskid ):
+        return self._database.tasks.ancestors( taskid )
 
     def select( self, parentid=None ):
-        return [ task for task in self._tasks.itervalues() if task['parent'] == parentid ]
+        if self._tasks is None:
+            self.refresh()
+        parent = self._node( parentid )
+        if not parent:
+            return []
+        return [ self._tasks[kid] for kid in parent.kids ]
+
+    def item( self, indices ):
+        """Return the task at a tree index path, the hidden root for an empty path."""
+        if self._tasks is None:
+            self.refresh()
+        task = self._root
+        for i in indices:
+            task = self._tasks[ task.kids[i] ]
+        return task
+
+#--------------------------------------------------------------------------
+RECORD_FIELDS = [ 'type', 'id', 'parent', 'status', 'name', 'details', 'date', 'ts', 'text' ]
+
+def write_records( out, records, format='jsonl' ):
+    """Stream export records to out as JSON Lines or CSV, returning the count written."""
+    import json, csv
+    count = 0
+    if format == 'csv':
+        writer = csv.writer( out )
+        writer.writerow( RECORD_FIELDS )
+        for record in records:
+            writer.writerow( [ _csv_encode( record.get( field ) ) for field in RECORD_FIELDS ] )
+            count += 1
+    else:
+        for record in records:
+            out.write( json.dumps( record ) )
+            out.write( "\n" )
+            count += 1
+    return count
+
+def read_records( src, format='jsonl' ):
+    """Lazily parse records from a JSON Lines or CSV stream."""
+    import json, csv
+    if format == 'csv':
+        for row in csv.DictReader( src ):
+            record = dict( ( field, _csv_decode( value ) ) for field, value in row.iteritems() if field in RECORD_FIELDS )
+            for field in [ 'id', 'parent', 'status' ]:
+                if record.get( field ) is not None and record[field].isdigit():
+                    record[field] = int( record[field] )
+            yield record
+    else:
+        for line in src:
+            if line.strip():
+                yield json.loads( line )
+
+def _csv_encode( value ):
+    if value is None:
+        return ''
+    if isinstance( value, unicode ):
+        return value.encode( 'utf-8' )
+    return value
+
+def _csv_decode( value ):
+    if value is None or value == '':
+        return None
+    return value.decode( 'utf-8' )
 
 #--------------------------------------------------------------------------
 class Notebook(object):
-    def __init__( self ):
-        self._database = Database()
+    def __init__( self, profiler=None ):
+        self._database = Database( profiler=profiler )
         self._tasks = Taskbook( self._database )
 
     def debug( self, out ):
         self._tasks.debug( out )
 
+    @property
+    def database( self ):
+        return self._database
+
     @property
     def tasks( self ):
         return self._tasks
 
 #--------------------------------------------------------------------------
 def do_list( book, args ):
-    book = Notebook()
-    book.tasks.list()
+    # list [--status O|C|W] [--root ID] [--depth N] [--limit N]
+    options = { '--status': None, '--root': None, '--depth': None, '--limit': None }
+    args = list( args )
+    while args:
+        arg = args.pop(0)
+        if arg not in options or not args:
+            usage( "Bad list arguments" )
+            return 1
+        options[arg] = args.pop(0)
+    try:
+        numbers = [ int( options[name] ) if options[name] is not None else None
+                    for name in ( '--root', '--depth', '--limit' ) ]
+    except ValueError:
+        usage( "Bad list arguments" )
+        return 1
+    try:
+        if not book.tasks.list( options['--status'], *numbers ):
+            usage( "No task %s" % options['--root'] )
+            return 1
+    except sqlite3.Error as e:
+        usage( str(e) )
+        return 1
     return 0
 
 #--------------------------------------------------------------------------
@@ -276,29 +2151,51 @@ def do_add( book, args ):
         usage( "Missing task name!" )
         return 1
 
-    if not book.tasks.add( name=name ):
+    taskid = book.tasks.add( name=name )
+    if not taskid:
         return 1
-    book.tasks.list()
+    book.tasks.show( [ taskid ] )
     return 0
 
 #--------------------------------------------------------------------------
 def do_delete( book, args ):
-    for x in args:
-        book.tasks.delete( int(x) )
-    book.tasks.list()
+    count = 0
+    try:
+        with book.tasks.batch():
+            for x in args:
+                count += book.tasks.delete( int(x) ) or 0
+    except sqlite3.Error:
+        return 1
+    print "Deleted %u tasks" % count
     return 0
 
 #--------------------------------------------------------------------------
 def do_move( book, args ):
+    # move ID... PARENT [--before ID]
+    before = None
+    if '--before' in args:
+        index = args.index( '--before' )
+        if index + 1 >= len(args):
+            usage( "Missing --before task id" )
+            return 1
+        before = args[ index + 1 ]
+        args = args[:index] + args[ index + 2: ]
     if len(args) < 2:
         usage( "Missing move arguments" )
         return 1
+    if not all( arg.isdigit() for arg in args + ( [ before ] if before is not None else [] ) ):
+        usage( "Bad move arguments, task ids are numbers" )
+        return 1
+    before = int( before ) if before is not None else None
 
     dest = int( args[-1] )
-    for source in args[:-1]:
-        if not book.tasks.move( int(source), dest ):
-            return 1
-    book.tasks.list()
+    try:
+        with book.tasks.batch():
+            for source in args[:-1]:
+                book.tasks.move( int(source), dest, before )
+    except sqlite3.Error:
+        return 1
+    book.tasks.show( [ int(source) for source in args[:-1] ] )
     return 0
 
 #--------------------------------------------------------------------------
@@ -310,7 +2207,326 @@ def do_edit( book, args ):
     if not book.tasks.update( int(args[0]), ' '.join( args[1:] ) ):
         return 1
 
-    book.tasks.list()
+    book.tasks.show( [ int(args[0]) ] )
+    return 0
+
+#--------------------------------------------------------------------------
+def _transfer_args( args ):
+    # [--csv|--jsonl] [file], format defaulting from the file extension
+    format, filename = None, None
+    for arg in args:
+        if arg in ( '--csv', '--jsonl' ):
+            format = arg[2:]
+        else:
+            filename = arg
+    if not format:
+        format = 'csv' if filename and filename.lower().endswith( '.csv' ) else 'jsonl'
+    return format, filename
+
+#--------------------------------------------------------------------------
+def do_export( book, args ):
+    format, filename = _transfer_args( args )
+    out = open( filename, 'wb' ) if filename else sys.stdout
+    try:
+        write_records( out, book.database.records(), format )
+    finally:
+        if filename:
+            out.close()
+    return 0
+
+#--------------------------------------------------------------------------
+def do_import( book, args ):
+    format, filename = _transfer_args( args )
+    src = open( filename, 'rb' ) if filename else sys.stdin
+    try:
+        counts = book.tasks.load( read_records( src, format ) )
+    except ValueError as e:
+        usage( "Bad import record: %s" % str(e) )
+        return 1
+    finally:
+        if filename:
+            src.close()
+    if not counts:
+        return 1
+    print "Imported %u tasks and %u messages" % counts
+    return 0
+
+#--------------------------------------------------------------------------
+def do_search( book, args ):
+    # [--tasks|--messages] [--raw] [--limit N] [--page N] query...
+    # --raw passes the query to FTS5 in its own syntax: "a phrase", prefix*, a OR b, NOT, NEAR
+    kinds, limit, page, raw, words = ( 'task', 'message' ), 20, 1, False, []
+    args = list( args )
+    while args:
+        arg = args.pop(0)
+        if arg == '--tasks':
+            kinds = ( 'task', )
+        elif arg == '--messages':
+            kinds = ( 'message', )
+        elif arg == '--raw':
+            raw = True
+        elif arg in ( '--limit', '--page' ) and args:
+            value = args.pop(0)
+            if not value.isdigit() or int( value ) < 1:
+                usage( "%s needs a positive number, not '%s'" % ( arg, value ) )
+                return 1
+            value = int( value )
+            if arg == '--limit':
+                limit = value
+            else:
+                page = value
+        else:
+            words.append( arg )
+
+    if not words:
+        usage( "Missing search query" )
+        return 1
+
+    results = book.tasks.search( ' '.join( words ), kinds=kinds, limit=limit, offset=limit*(page-1), raw=raw )
+    if results is None:
+        return 1
+    for result in results:
+        print "%-7s %4i : %s" % ( result['type'], result['id'], result['text'] )
+    return 0
+
+#--------------------------------------------------------------------------
+def do_log( book, args ):
+    # log <text...> | log [--since DATE] [--until DATE] [--after ID] [--limit N] | log --daily [--since DATE] [--until DATE]
+    options = { '--since': None, '--until': None, '--after': None, '--limit': None }
+    args = list( args )
+    if args and args[0] == '--daily':
+        return do_daily( book, args[1:] )
+    if args and args[0] not in options:
+        return 0 if book.database.messages.insert( ' '.join( args ) ) else 1
+
+    while args:
+        arg = args.pop(0)
+        if arg not in options or not args:
+            usage( "Bad log arguments" )
+            return 1
+        options[arg] = args.pop(0)
+
+    messages = book.database.messages.iterate(
+        since=options['--since'], until=options['--until'],
+        after_id=int( options['--after'] ) if options['--after'] else None,
+        limit=int( options['--limit'] ) if options['--limit'] else None )
+    for msgid, date, ts, text in messages:
+        print "%5i %s : %s" % ( msgid, ts, text )
+    return 0
+
+def do_daily( book, args ):
+    options = { '--since': None, '--until': None }
+    args = list( args )
+    while args:
+        arg = args.pop(0)
+        if arg not in options or not args:
+            usage( "Bad log arguments" )
+            return 1
+        options[arg] = args.pop(0)
+
+    days = book.database.messages.daily( since=options['--since'], until=options['--until'] )
+    if days is None:
+        return 1
+    for date, count, first, last, archived in days:
+        # imported messages may have no ts
+        print "%s %5u  %8s - %8s%s" % ( date, count, ( first or '' )[11:19], ( last or '' )[11:19], '  (archived)' if archived else '' )
+    return 0
+
+#--------------------------------------------------------------------------
+def do_archive( book, args ):
+    # archive [--keep DAYS | --before DATE] [--vacuum]
+    before = datetime.date.today() - datetime.timedelta( days=ARCHIVE_KEEP_DAYS )
+    vacuum = '--vacuum' in args
+    args = [ arg for arg in args if arg != '--vacuum' ]
+    if len(args) == 2 and args[0] == '--keep' and args[1].isdigit():
+        before = datetime.date.today() - datetime.timedelta( days=int( args[1] ) )
+    elif len(args) == 2 and args[0] == '--before':
+        before = args[1]
+    elif args:
+        usage( "Bad archive arguments" )
+        return 1
+
+    moved = book.database.messages.archive( str( before ) )
+    if moved is None:
+        return 1
+    print "Archived %u messages from %u days before %s" % ( moved[1], moved[0], before )
+    if vacuum and moved[1]:
+        # hand the freed pages back to the file system, VACUUM goes through the WAL
+        book.database.connection().execute( "VACUUM" )
+        book.database.connection().execute( "PRAGMA wal_checkpoint(TRUNCATE)" ).fetchall()
+    return 0
+
+#--------------------------------------------------------------------------
+def do_backup( book, args ):
+    # backup [FILE] [--vacuum] [--no-check] | backup --list
+    if args == [ '--list' ]:
+        rows = book.database.backups()
+        if rows is None:
+            return 1
+        for ts, filename, method, size, seconds, integrity in rows:
+            print "%s %-6s %8.1f MiB %6.1f s  %-3s %s" % ( ts, method, size / 1048576.0, seconds, integrity or '-', filename )
+        return 0
+
+    vacuum = '--vacuum' in args
+    check = '--no-check' not in args
+    args = [ arg for arg in args if arg not in ( '--vacuum', '--no-check' ) ]
+    if len(args) > 1 or ( args and args[0].startswith( '--' ) ):
+        usage( "Bad backup arguments" )
+        return 1
+    if args:
+        filename = args[0]
+    else:
+        folder = os.path.join( os.path.dirname( os.path.abspath( book.database.filename ) ), 'backup' )
+        if not os.path.exists( folder ):
+            os.makedirs( folder )
+        filename = os.path.join( folder, 'tasks-%s.db' % datetime.datetime.now().strftime( '%Y%m%d-%H%M%S' ) )
+
+    result = book.database.snapshot( filename, vacuum=vacuum, check=check )
+    if result is None:
+        return 1
+    print "Backed up %.1f MiB to %s in %.1f s by %s, integrity %s" % (
+        result['bytes'] / 1048576.0, result['filename'], result['seconds'], result['method'], result['integrity'] or 'not checked' )
+    return 0 if result['integrity'] in ( None, 'ok' ) else 1
+
+#--------------------------------------------------------------------------
+def do_hierarchy( book, args ):
+    # hierarchy [on|off]
+    tasks = book.database.tasks
+    if args == [ 'on' ]:
+        tasks.create_hierarchy()
+        if not tasks.hierarchy:
+            return 1
+    elif args == [ 'off' ]:
+        if not tasks.drop_hierarchy():
+            return 1
+    elif args:
+        usage( "Bad hierarchy arguments" )
+        return 1
+    print "Hierarchy index is %s" % ( 'on' if tasks.hierarchy else 'off' )
+    return 0
+
+#--------------------------------------------------------------------------
+def do_daemon( book, args ):
+    # daemon [start|stop|status]
+    action = args[0] if args else 'start'
+    if action == 'start':
+        if request( { 'status': True } ) is not None:
+            usage( "task daemon is already running" )
+            return 1
+        import taskd
+        book.tasks.sync()
+        return taskd.serve( GetSocketPath(), book, dispatch )
+    if action in ( 'stop', 'status' ):
+        reply = request( { action: True } )
+        if reply is None:
+            print "task daemon is not running"
+            return 1
+        print "task daemon is %s" % ( 'stopping' if action == 'stop' else 'running' )
+        return 0
+    usage( "Unknown daemon action '%s'" % action )
+    return 1
+
+#--------------------------------------------------------------------------
+def do_status( book, args ):
+    if len(args) < 2:
+        usage( "Missing status arguments" )
+        return 1
+
+    try:
+        with book.tasks.batch():
+            for taskid in args[:-1]:
+                book.tasks.set_status( int(taskid), args[-1] )
+    except sqlite3.Error:
+        return 1
+    book.tasks.show( [ int(taskid) for taskid in args[:-1] ] )
+    return 0
+
+#--------------------------------------------------------------------------
+BATCH_OPERATIONS = {
+    # name : ( minimum args, function( taskbook, args ) )
+    'add'    : ( 1, lambda tasks, args: tasks.add( ' '.join( args ) ) ),
+    'edit'   : ( 2, lambda tasks, args: tasks.update( int(args[0]), ' '.join( args[1:] ) ) ),
+    'move'   : ( 2, lambda tasks, args: all( [ tasks.move( int(id), int(args[-1]) ) for id in args[:-1] ] ) ),
+    'delete' : ( 1, lambda tasks, args: all( [ tasks.delete( int(id) ) is not None for id in args ] ) ),
+    'status' : ( 2, lambda tasks, args: all( [ tasks.set_status( int(id), args[-1] ) for id in args[:-1] ] ) )
+}
+
+def do_batch( book, args ):
+    """Apply operations read from stdin, one per line, in a single transaction."""
+    count = 0
+    try:
+        with book.tasks.batch():
+            for number, line in enumerate( sys.stdin, 1 ):
+                words = line.split()
+                if not words or words[0].startswith( '#' ):
+                    continue
+                operation = BATCH_OPERATIONS.get( words[0] )
+                if not operation or len( words ) - 1 < operation[0]:
+                    raise ValueError( "line %u: bad operation '%s'" % ( number, line.strip() ) )
+                if not operation[1]( book.tasks, [ word.decode( 'utf-8' ) for word in words[1:] ] ):
+                    raise ValueError( "line %u: '%s' failed" % ( number, line.strip() ) )
+                count += 1
+    except ( ValueError, sqlite3.Error ) as e:
+        usage( "Batch rolled back, %s" % str(e) )
+        return 1
+    print "Applied %u operations" % count
+    return 0
+
+#--------------------------------------------------------------------------
+def do_changes( book, args ):
+    # changes [--since SEQ] [--limit N] | changes --compact [SEQ]
+    if args and args[0] == '--compact':
+        count = book.database.changes.compact( int(args[1]) if len(args) > 1 else None )
+        if count is None:
+            return 1
+        print "Compacted %u changes" % count
+        return 0
+
+    options = { '--since': '0', '--limit': None }
+    args = list( args )
+    while args:
+        arg = args.pop(0)
+        if arg not in options or not args:
+            usage( "Bad changes arguments" )
+            return 1
+        options[arg] = args.pop(0)
+
+    changes = book.database.changes.since( int( options['--since'] ),
+                                           int( options['--limit'] ) if options['--limit'] else None )
+    if changes is None:
+        usage( "Changes since %s were compacted, reload instead" % options['--since'] )
+        return 1
+    for change in changes:
+        print "%6i %s %-7s %-6s %4i" % ( change['seq'], change['ts'], change['tablename'], change['op'], change['id'] )
+    return 0
+
+#--------------------------------------------------------------------------
+def do_stats( book, args ):
+    # stats [--json] [--reset] [--limit N] | stats --contention [--reset]
+    if args[:1] == [ '--contention' ]:
+        counts = book.database.contention( reset=args[1:] == [ '--reset' ] )
+        print "%u transactions, %u contended, %u retries, %u failed, waited %.3f s, longest %.3f s" % tuple(
+            counts[name] for name in CONTENTION_COUNTERS )
+        return 0
+    profiler = book.database.profiler
+    if profiler is None:
+        usage( "Profiling is off, run with --profile or TASK_PROFILE=1" )
+        return 1
+    if args == [ '--reset' ]:
+        profiler.reset()
+        return 0
+    if args == [ '--json' ]:
+        import json
+        json.dump( profiler.dump(), sys.stdout, indent=1 )
+        print
+        return 0
+    if len(args) == 2 and args[0] == '--limit':
+        profiler.report( sys.stdout, limit=int( args[1] ) )
+        return 0
+    if args:
+        usage( "Bad stats arguments" )
+        return 1
+    profiler.report( sys.stdout )
     return 0
 
 #--------------------------------------------------------------------------
@@ -327,6 +2543,18 @@ COMMANDS = {
     'move'    : do_move,
     'mv'      : do_move,
     'edit'    : do_edit,
+    'import'  : do_import,
+    'export'  : do_export,
+    'search'  : do_search,
+    'log'     : do_log,
+    'daemon'  : do_daemon,
+    'status'  : do_status,
+    'batch'   : do_batch,
+    'changes' : do_changes,
+    'stats'   : do_stats,
+    'archive' : do_archive,
+    'backup'  : do_backup,
+    'hierarchy' : do_hierarchy,
     'debug'   : do_debug
 }
 
@@ -337,7 +2565,59 @@ def usage( err=None ):
     print "usage: TODO"
 
 #--------------------------------------------------------------------------
-def main( args ):
+# Commands the daemon never runs: they manage it, or read and write the
+# caller's stdin and files.
+LOCAL_COMMANDS = set([ 'daemon', 'import', 'export', 'batch', 'backup' ])
+
+def GetSocketPath():
+    return os.path.join( GetConfigDir(), 'taskd.sock' )
+
+#--------------------------------------------------------------------------
+# A command request carries the time it expires, DAEMON_START_TIMEOUT seconds
+# after it is sent. The daemon acknowledges a request before running it and
+# drops one that has expired, so a client that hears nothing in time can run
+# the command itself without it running twice; DAEMON_ACK_GRACE covers the ack
+# still on its way. After the ack the client waits up to DAEMON_RUN_TIMEOUT
+# seconds for the reply.
+DAEMON_START_TIMEOUT = 2.0
+DAEMON_ACK_GRACE = 0.5
+DAEMON_RUN_TIMEOUT = 600.0
+
+def request( message, timeout=DAEMON_START_TIMEOUT ):
+    """
+    Send one JSON request to the daemon, returning its reply or None if it is not
+    running or did not take the request up within timeout seconds.
+    """
+    path = GetSocketPath()
+    if not os.path.exists( path ):
+        return None
+    import json, socket
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    started = False
+    try:
+        sock.settimeout( timeout + DAEMON_ACK_GRACE )
+        sock.connect( path )
+        sock.sendall( json.dumps( dict( message, expires=time.time() + timeout ) ) + "\n" )
+        sock.shutdown( socket.SHUT_WR )
+        replies = sock.makefile( 'rb' )
+        reply = json.loads( replies.readline() or 'null' )
+        if reply is not None and reply.get( 'started' ):
+            started = True
+            sock.settimeout( DAEMON_RUN_TIMEOUT )
+            reply = json.loads( replies.readline() or 'null' )
+        if reply is None and started:
+            raise socket.error( "connection closed" )
+        return reply
+    except ( socket.error, ValueError ) as e:
+        if not started:
+            return None
+        # the daemon has run or is still running the command, it must not run again here
+        return { 'status': 1, 'stdout': u'', 'stderr': u'task daemon did not finish the command: %s\n' % e }
+    finally:
+        sock.close()
+
+#--------------------------------------------------------------------------
+def dispatch( book, args ):
     if len(args) > 0:
         command = args[0]
         args = args[1:]
@@ -349,7 +2629,27 @@ def main( args ):
         usage( "Unknown command '%s'" % command )
         return 1
 
-    return func( Notebook(), args )
+    return func( book, args )
+
+#--------------------------------------------------------------------------
+def main( args ):
+    # --profile runs the command here, not in the daemon, and reports its timings on stderr
+    profile = bool( args ) and args[0] == '--profile'
+    if profile:
+        args = args[1:]
+    command = args[0] if args else "list"
+    if not profile and command not in LOCAL_COMMANDS and not os.environ.get( 'TASK_NO_DAEMON' ):
+        reply = request( { 'args': args } )
+        if reply is not None:
+            sys.stdout.write( reply['stdout'].encode( 'utf-8' ) )
+            sys.stderr.write( reply['stderr'].encode( 'utf-8' ) )
+            return reply['status']
+
+    book = Notebook( Profiler() if profile or os.environ.get( 'TASK_PROFILE' ) else None )
+    status = dispatch( book, args )
+    if profile:
+        book.database.profiler.report( sys.stderr )
+    return status
 
 #--------------------------------------------------------------------------
 if __name__ == "__main__":
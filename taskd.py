@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Long running task daemon, started with 'task daemon'.
+
+Holds one open database and a warm Taskbook cache and runs task.COMMANDS for
+clients connecting over a Unix domain socket. Each request is one line of
+JSON, { "args": [...] }, answered with one line { "status", "stdout", "stderr" }.
+"""
+
+import sys
+import os.path
+import json
+import time
+import socket
+import logging
+import traceback
+import SocketServer
+import StringIO
+
+#--------------------------------------------------------------------------
+# Seconds a client gets to send its request and take each write of the reply;
+# one that stalls would otherwise hold up every other client.
+CLIENT_TIMEOUT = 10.0
+
+#--------------------------------------------------------------------------
+class TaskRequestHandler(SocketServer.StreamRequestHandler):
+    timeout = CLIENT_TIMEOUT
+
+    def handle( self ):
+        try:
+            message = json.loads( self.rfile.readline() )
+            if message.get( 'stop' ):
+                self.server.stopping = True
+                reply = { 'status': 0 }
+            elif message.get( 'status' ):
+                reply = { 'status': 0 }
+            elif message.get( 'expires', float( 'inf' ) ) < time.time():
+                return # the client gave up waiting and runs the command itself
+            else:
+                # the client only falls back to running the command without this
+                self.wfile.write( json.dumps( { 'started': True } ) + "\n" )
+                reply = self.server.run( message.get( 'args', [] ) )
+            self.wfile.write( json.dumps( reply ) + "\n" )
+        except ( ValueError, socket.error ) as e:
+            logging.warning( "Dropped client request: %s", str( e ) )
+
+#--------------------------------------------------------------------------
+class TaskServer(SocketServer.UnixStreamServer):
+    """Serves COMMANDS over a Unix socket from one open database and warm Taskbook cache."""
+
+    def __init__( self, path, book, dispatch ):
+        self.book = book
+        self.dispatch = dispatch
+        self.stopping = False
+        SocketServer.UnixStreamServer.__init__( self, path, TaskRequestHandler )
+
+    def run( self, args ):
+        # capture what the command prints and logs so the client can replay it
+        out, err = StringIO.StringIO(), StringIO.StringIO()
+        handler = logging.StreamHandler( err )
+        logging.getLogger().addHandler( handler )
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            status = self.dispatch( self.book, args )
+        except Exception:
+            err.write( traceback.format_exc() )
+            status = 1
+        finally:
+            sys.stdout = stdout
+            logging.getLogger().removeHandler( handler )
+        return { 'status': status, 'stdout': out.getvalue(), 'stderr': err.getvalue() }
+
+#--------------------------------------------------------------------------
+def serve( path, book, dispatch ):
+    """Serve requests on path until a client asks the daemon to stop."""
+    if os.path.exists( path ):
+        os.remove( path ) # left behind by a daemon that did not shut down cleanly
+    server = TaskServer( path, book, dispatch )
+    try:
+        while not server.stopping:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove( path )
+    return 0